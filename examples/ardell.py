@@ -1,5 +1,5 @@
 from pprint import pprint
-from mapknowledge import KnowledgeStore
+from mapknowledge import get_store
 
 MODEL_URI = 'https://apinatomy.org/uris/models/ard-arm-cardiac'
 
@@ -8,21 +8,22 @@ MODEL_ABBRV = 'aacar'
 def NEURON_URI(n):
     return f'ilxtr:neuron-type-{MODEL_ABBRV}-{n}'
 
-def print_knowledge(store, entity):
+def print_knowledge(entity, knowledge):
     print(f'{entity}:')
-    pprint(store.entity_knowledge(entity))
+    pprint(knowledge)
     print()
 
+def print_entities_knowledge(store, entities):
+    for entity, knowledge in store.entities_knowledge(entities).items():
+        print_knowledge(entity, knowledge)
+
 def print_phenotypes(store, entity):
     print("Querying", entity)
-    knowledge = store.entity_knowledge(entity)
-    print(f'{entity}: {knowledge.get("phenotypes", [])}')
+    print(f'{entity}: {store.phenotypes(entity)}')
 
 if __name__ == '__main__':
-    store = KnowledgeStore(store_directory='.')
+    store = get_store(store_directory='.')
 
-    print_knowledge(store, MODEL_URI)
-    for n in [13]:
-        print_knowledge(store, NEURON_URI(n))
+    print_entities_knowledge(store, [MODEL_URI] + [NEURON_URI(n) for n in [13]])
 
     store.close()
@@ -1,5 +1,5 @@
 from pprint import pprint
-from mapknowledge import KnowledgeStore
+from mapknowledge import get_store
 from mapknowledge.scicrunch import SCICRUNCH_PRODUCTION, SCICRUNCH_STAGING
 
 KEAST_MODEL = 'https://apinatomy.org/uris/models/keast-bladder'
@@ -7,28 +7,29 @@ KEAST_MODEL = 'https://apinatomy.org/uris/models/keast-bladder'
 def KEAST_NEURON(n):
     return f'ilxtr:neuron-type-keast-{n}'
 
-def print_knowledge(store, entity):
+def print_knowledge(entity, knowledge):
     print(f'{entity}:')
-    pprint(store.entity_knowledge(entity))
+    pprint(knowledge)
     print()
 
+def print_entities_knowledge(store, entities):
+    for entity, knowledge in store.entities_knowledge(entities).items():
+        print_knowledge(entity, knowledge)
+
 def print_phenotypes(store, entity):
     print("Querying", entity)
-    knowledge = store.entity_knowledge(entity)
-    print(f'{entity}: {knowledge.get("phenotypes", [])}')
+    print(f'{entity}: {store.phenotypes(entity)}')
 
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.INFO)
 
     print('Production:')
-    store = KnowledgeStore(scicrunch_release=SCICRUNCH_PRODUCTION)
-    print_knowledge(store, KEAST_MODEL)
-    print_knowledge(store, KEAST_NEURON(9))
+    store = get_store(scicrunch_release=SCICRUNCH_PRODUCTION)
+    print_entities_knowledge(store, [KEAST_MODEL, KEAST_NEURON(9)])
     store.close()
 
     print('Staging:')
-    store = KnowledgeStore(scicrunch_release=SCICRUNCH_STAGING)
-    print_knowledge(store, KEAST_MODEL)
-    print_knowledge(store, KEAST_NEURON(9))
+    store = get_store(scicrunch_release=SCICRUNCH_STAGING)
+    print_entities_knowledge(store, [KEAST_MODEL, KEAST_NEURON(9)])
     store.close()
@@ -23,49 +23,188 @@ __version__ = "0.12.1"
 #===============================================================================
 
 import sqlite3
-import datetime
-import json
 import os
+import threading
+import time
 
+from contextlib import contextmanager
 from pathlib import Path
 
 #===============================================================================
 
 from .apinatomy import Apinatomy
 from .scicrunch import SCICRUNCH_API_ENDPOINT, SCICRUNCH_PRODUCTION, SCICRUNCH_STAGING
+from .scicrunch import SCICRUNCH_SPARC_API
 from .scicrunch import SciCrunch
-from .utils import log
+from .utils import json_dumps, json_loads, log
 
 #===============================================================================
 
 KNOWLEDGE_BASE = 'knowledgebase.sqlite'
 
+# Keep ``in (?, ?, ...)`` queries under SQLite's default SQLITE_MAX_VARIABLE_NUMBER
+MAX_SQL_VARIABLES = 999
+
+# Only load all knowledge into memory when opening a store if there's no more than this
+PREWARM_LIMIT = 50000
+
+# How many SciCrunch requests ``KnowledgeStore.prefetch()`` makes at once
+PREFETCH_WORKERS = 16
+
+# Seconds before SciCrunch is asked again about an entity it didn't know
+UNKNOWN_ENTITY_RETRY = 24*60*60
+
 #===============================================================================
 
-KNOWLEDGE_SCHEMA = """
-    begin;
-    create table metadata (name text primary key, value text);
+# Knowledge bases created before schema versioning was introduced are version 1.
+# Tables with small rows are WITHOUT ROWID, so a lookup is a single b-tree search;
+# ``knowledge`` has large rows and keeps its rowid
+SCHEMA_VERSION = 6
+
+KNOWLEDGE_SCHEMA = f"""
+    begin immediate;
+    create table metadata (name text primary key, value text) without rowid;
+    insert into metadata values ('schema_version', '{SCHEMA_VERSION}');
 
     create table knowledge (entity text primary key, knowledge text);
-    create unique index knowledge_index on knowledge(entity);
 
-    create table labels (entity text primary key, label text);
-    create unique index labels_index on labels(entity);
+    create table labels (entity text primary key, label text) without rowid;
 
-    create table publications (entity text, publication text);
-    create index publications_entity_index on publications(entity);
+    create table publications (entity text, publication text, primary key(entity, publication)) without rowid;
     create index publications_publication_index on publications(publication);
 
-    create table connectivity_models (model text primary key);
+    create table connectivity_models (model text primary key) without rowid;
+
+    create table phenotypes (entity text, phenotype text, primary key(entity, phenotype));
+
+    create table unknown_entities (entity text primary key, checked real) without rowid;
     commit;
 """
 
+# Upgrade a knowledge base from the previous version. Each is run, and its version
+# recorded, in a single transaction (see ``KnowledgeBase.__upgrade_schema()``)
+SCHEMA_UPGRADES = {
+    2: """
+        create table if not exists phenotypes (entity text, phenotype text, primary key(entity, phenotype));
+        insert or ignore into phenotypes(entity, phenotype)
+            select k.entity, p.value from knowledge as k, json_each(k.knowledge, '$.phenotypes') as p
+                where json_extract(k.knowledge, '$.phenotypes') is not null;
+    """,
+    3: """
+        create table publications_new (entity text, publication text, primary key(entity, publication)) without rowid;
+        insert or ignore into publications_new(entity, publication)
+            select entity, publication from publications;
+        drop table publications;
+        alter table publications_new rename to publications;
+        create index publications_publication_index on publications(publication);
+    """,
+    4: """
+        drop index if exists knowledge_index;
+        drop index if exists labels_index;
+
+        create table labels_new (entity text primary key, label text) without rowid;
+        insert into labels_new(entity, label) select entity, label from labels where entity is not null;
+        drop table labels;
+        alter table labels_new rename to labels;
+
+        create table connectivity_models_new (model text primary key) without rowid;
+        insert into connectivity_models_new(model) select model from connectivity_models where model is not null;
+        drop table connectivity_models;
+        alter table connectivity_models_new rename to connectivity_models;
+
+        create table metadata_new (name text primary key, value text) without rowid;
+        insert into metadata_new(name, value) select name, value from metadata where name is not null;
+        drop table metadata;
+        alter table metadata_new rename to metadata;
+    """,
+    5: """
+        create table if not exists unknown_entities (entity text primary key, checked real) without rowid;
+    """,
+    6: """
+        create table phenotypes_new (entity text, phenotype text, primary key(entity, phenotype));
+        insert or ignore into phenotypes_new(entity, phenotype)
+            select entity, phenotype from phenotypes order by rowid;
+        drop table phenotypes;
+        alter table phenotypes_new rename to phenotypes;
+    """,
+}
+
+# Used by every connection; wait for other writers rather than failing
+# immediately when the database is locked
+KNOWLEDGE_PRAGMAS = """
+    pragma busy_timeout=5000;
+    pragma temp_store=MEMORY;
+    pragma mmap_size=268435456;
+    pragma cache_size=-64000;
+"""
+
+# Write-ahead logging lets readers proceed while we write and, with NORMAL
+# synchronisation, only syncs at checkpoints instead of at every commit
+KNOWLEDGE_WRITE_PRAGMAS = """
+    pragma journal_mode=WAL;
+    pragma synchronous=NORMAL;
+"""
+
+#===============================================================================
+
+# Size of each connection's prepared statement cache (sqlite3's default is 128)
+CACHED_STATEMENTS = 256
+
+# SQL used on every lookup, kept as constants so that each is prepared just once
+# and then found in the connection's statement cache. Rows are updated in place
+# with upserts rather than being deleted and reinserted by ``replace``
+
+SQL_SELECT_METADATA = 'select value from metadata where name=?'
+SQL_UPSERT_METADATA = 'insert into metadata(name, value) values (?, ?) on conflict(name) do update set value=excluded.value'
+
+SQL_SELECT_KNOWLEDGE = 'select knowledge from knowledge where entity=?'
+SQL_SELECT_ALL_KNOWLEDGE = 'select entity, knowledge from knowledge'
+SQL_COUNT_KNOWLEDGE = 'select count(*) from knowledge'
+SQL_SELECT_KNOWLEDGE_IN = 'select entity, knowledge from knowledge where entity in ({})'
+SQL_SELECT_ENTITIES_IN = 'select entity from knowledge where entity in ({})'
+SQL_UPSERT_KNOWLEDGE = 'insert into knowledge(entity, knowledge) values (?, ?) on conflict(entity) do update set knowledge=excluded.knowledge'
+
+SQL_SELECT_LABEL = 'select label from labels where entity=?'
+SQL_SELECT_LABELS = 'select entity, label from labels order by entity'
+SQL_SELECT_LABELS_IN = 'select entity, label from labels where entity in ({})'
+SQL_UPSERT_LABEL = 'insert into labels(entity, label) values (?, ?) on conflict(entity) do update set label=excluded.label'
+
+SQL_SELECT_PUBLICATIONS = 'select publication from publications where entity = ?'
+SQL_DELETE_PUBLICATION = 'delete from publications where entity = ? and publication = ?'
+SQL_INSERT_PUBLICATION = 'insert or ignore into publications(entity, publication) values (?, ?)'
+
+SQL_SELECT_PHENOTYPES = 'select phenotype from phenotypes where entity=? order by rowid'
+SQL_DELETE_PHENOTYPES = 'delete from phenotypes where entity = ?'
+SQL_INSERT_PHENOTYPE = 'insert or ignore into phenotypes(entity, phenotype) values (?, ?)'
+
+SQL_SELECT_UNKNOWN_IN = 'select entity from unknown_entities where checked > ? and entity in ({})'
+SQL_DELETE_UNKNOWN = 'delete from unknown_entities where entity = ?'
+SQL_UPSERT_UNKNOWN = 'insert into unknown_entities(entity, checked) values (?, ?) on conflict(entity) do update set checked=excluded.checked'
+
+# Tables cleared of connectivity knowledge by ``clean_connectivity``
+CONNECTIVITY_TABLES = ['knowledge', 'labels', 'publications', 'phenotypes', 'unknown_entities']
+
+SQL_SELECT_CONNECTIVITY_MODELS = """
+    select c.model, l.label from connectivity_models as c
+        left join labels as l on c.model = l.entity order by model
+"""
+SQL_UPSERT_CONNECTIVITY_MODEL = 'insert into connectivity_models(model) values (?) on conflict(model) do nothing'
+
+#===============================================================================
+
+def scalar_row(cursor, row):
+#===========================
+    return row[0]
+
 #===============================================================================
 
 class KnowledgeBase(object):
-    def __init__(self, store_directory, read_only=False, create=False, knowledge_base=KNOWLEDGE_BASE):
+    def __init__(self, store_directory, read_only=False, create=False, knowledge_base=KNOWLEDGE_BASE, immutable=False):
         self.__db = None
+        self.__scalar_cursor = None
+        self.__transaction_depth = 0
         self.__read_only = read_only
+        self.__schema_version = 0
         if store_directory is None:
             self.__db_name = None
         else:
@@ -75,12 +214,12 @@ class KnowledgeBase(object):
             # Create knowledge base if it doesn't exist
             self.__db_name = Path(store_directory, knowledge_base).resolve()
             if create and not self.__db_name.exists():
-                db = sqlite3.connect(self.__db_name,
-                    detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+                db = sqlite3.connect(self.__db_name)
                 db.executescript(KNOWLEDGE_SCHEMA)
                 db.close()
-            ## What about upgrading when tables (e.g. knowledge) don't exist???
-            self.open(read_only=read_only)
+            self.open(read_only=read_only, immutable=immutable)
+            if not read_only:
+                self.__upgrade_schema()
 
     @property
     def db(self):
@@ -94,31 +233,102 @@ class KnowledgeBase(object):
     def read_only(self):
         return self.__read_only
 
+    @property
+    def schema_version(self):
+        return self.__schema_version
+
     def close(self):
         if self.__db is not None:
+            if not self.__read_only:
+                # Refresh query planner statistics if SQLite thinks they are needed
+                self.__db.execute('pragma optimize')
             self.__db.close()
             self.__db = None
+            self.__scalar_cursor = None
 
-    def open(self, read_only=False):
-        self.close()
-        db_uri = '{}?mode=ro'.format(self.__db_name.as_uri()) if read_only else self.__db_name.as_uri()
-        self.__db = sqlite3.connect(db_uri, uri=True,
-                                    detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    def open(self, read_only=False, immutable=False):
+        KnowledgeBase.close(self)
+        self.__read_only = read_only
+        if read_only and immutable:
+            # SQLite then neither locks nor checks for changes, so the knowledge base
+            # mustn't be written to (and must have been checkpointed) while we're open
+            db_uri = '{}?mode=ro&immutable=1'.format(self.__db_name.as_uri())
+        elif read_only:
+            db_uri = '{}?mode=ro'.format(self.__db_name.as_uri())
+        else:
+            db_uri = self.__db_name.as_uri()
+        self.__db = sqlite3.connect(db_uri, uri=True, cached_statements=CACHED_STATEMENTS)
+        # Single column queries return values rather than tuples
+        self.__scalar_cursor = self.__db.cursor()
+        self.__scalar_cursor.row_factory = scalar_row
+        self.__db.executescript(KNOWLEDGE_PRAGMAS)
+        if read_only:
+            self.__db.execute('pragma query_only=ON')
+        else:
+            self.__db.executescript(KNOWLEDGE_WRITE_PRAGMAS)
+        # An empty database (i.e. no tables) is version 0
+        if self.__db.execute("select name from sqlite_master where type='table' and name='metadata'").fetchone():
+            self.__schema_version = int(self.metadata('schema_version') or 1)
+        else:
+            self.__schema_version = 0
+
+    def __upgrade_schema(self):
+    #==========================
+        # Each upgrade holds the write lock while it checks the version, so one
+        # already applied by another connection isn't repeated, and is rolled back
+        # if it fails. ``executescript()`` would commit, so statements are run singly
+        while 0 < self.__schema_version < SCHEMA_VERSION:
+            with self.transaction():
+                self.__schema_version = int(self.metadata('schema_version') or 1)
+                if self.__schema_version < SCHEMA_VERSION:
+                    version = self.__schema_version + 1
+                    log.info(f'Upgrading knowledge base to schema version {version}...')
+                    for statement in SCHEMA_UPGRADES[version].split(';'):
+                        if statement.strip():
+                            self.__db.execute(statement)
+                    self.set_metadata('schema_version', str(version))
+                    self.__schema_version = version
 
     def metadata(self, name):
-        row = self.__db.execute('select value from metadata where name=?', (name,)).fetchone()
-        if row is not None:
-            return row[0]
+        return self.scalar(SQL_SELECT_METADATA, (name,))
+
+    def scalar(self, sql, parameters=()):
+        return self.__scalar_cursor.execute(sql, parameters).fetchone()
+
+    def scalars(self, sql, parameters=()):
+        return self.__scalar_cursor.execute(sql, parameters).fetchall()
 
     def set_metadata(self, name, value):
-        if not self.__db.in_transaction:
-            self.__db.execute('begin')
-        self.db.execute('replace into metadata values (?, ?)', (name,value))
-        self.__db.execute('commit')
+        with self.transaction():
+            self.__db.execute(SQL_UPSERT_METADATA, (name,value))
+
+    @contextmanager
+    def transaction(self):
+    #=====================
+        # Transactions nest, with only the outermost one beginning
+        # and then either committing or rolling back. We take the write
+        # lock immediately, rather than failing with SQLITE_BUSY when
+        # upgrading from a read lock if another connection is writing
+        if self.__transaction_depth == 0 and not self.__db.in_transaction:
+            self.__db.execute('begin immediate')
+        self.__transaction_depth += 1
+        try:
+            yield self.__db
+        except BaseException:
+            self.__transaction_depth -= 1
+            if self.__transaction_depth == 0:
+                self.__db.rollback()
+            raise
+        self.__transaction_depth -= 1
+        if self.__transaction_depth == 0:
+            self.__db.commit()
 
 #===============================================================================
 
 class KnowledgeStore(KnowledgeBase):
+    __shared_stores = {}
+    __shared_lock = threading.Lock()
+
     def __init__(self, store_directory=None,
                        knowledge_base=KNOWLEDGE_BASE,
                        clean_connectivity=False,
@@ -126,64 +336,120 @@ class KnowledgeStore(KnowledgeBase):
                        scicrunch_release=SCICRUNCH_PRODUCTION,
                        scicrunch_key=None,
                        create=True,
-                       read_only=False):
-        super().__init__(store_directory, create=create, knowledge_base=knowledge_base, read_only=read_only)
+                       read_only=False,
+                       immutable=False,
+                       prewarm=False,
+                       prewarm_limit=PREWARM_LIMIT):
+        self.__shared_key = None
+        self.__shared_count = 0
+        super().__init__(store_directory, create=create, knowledge_base=knowledge_base,
+                         read_only=read_only, immutable=immutable)
         self.__entity_knowledge = {}     # Cache lookups
+        self.__entity_labels = {}
 
         if (db_name := self.db_name) is not None:
             cache_msg = f'with cache {db_name}'
         else:
             cache_msg = f'with no cache'
+        # SciCrunch is only connected to when we first need to use it
+        self.__scicrunch = None
         if scicrunch_api is not None:
-            self.__scicrunch = SciCrunch(api_endpoint=scicrunch_api,
-                                         scicrunch_release=scicrunch_release,
-                                         scicrunch_key=scicrunch_key)
+            self.__scicrunch_params = {
+                'api_endpoint': scicrunch_api,
+                'scicrunch_release': scicrunch_release,
+                'scicrunch_key': scicrunch_key
+            }
             release = 'production' if scicrunch_release == SCICRUNCH_PRODUCTION else 'staging'
-            scicrunch_msg = f'using {release} SciCrunch at {self.__scicrunch.sparc_api_endpoint}'
+            sparc_api_endpoint = SCICRUNCH_SPARC_API.format(API_ENDPOINT=scicrunch_api,
+                                                            SCICRUNCH_RELEASE=scicrunch_release)
+            scicrunch_msg = f'using {release} SciCrunch at {sparc_api_endpoint}'
         else:
-            self.__scicrunch = None
+            self.__scicrunch_params = None
             scicrunch_msg = 'not using SciCrunch'
         log.info(f'Map Knowledge version {__version__} {cache_msg} {scicrunch_msg}')
+        # Connectivity knowledge cached from a different SciCrunch release is out of date
+        if (self.db is not None and not self.read_only
+        and self.__scicrunch_params is not None
+        and (cached_endpoint := self.metadata('sparc_api_endpoint')) != sparc_api_endpoint):
+            if cached_endpoint is not None:
+                log.info(f'Cached knowledge is from {cached_endpoint}')
+                clean_connectivity = True
+            self.set_metadata('sparc_api_endpoint', sparc_api_endpoint)
         # Optionally clear local connectivity knowledge from SciCrunch
         if (self.db is not None and clean_connectivity):
             log.info(f'Clearing connectivity knowledge...')
-            entities = [f'{Apinatomy.APINATOMY_MODEL_PREFIX}%']
-            entities.extend([f'{ontology}:%' for ontology in Apinatomy.CONNECTIVITY_ONTOLOGIES])
-            condition = ' or '.join(len(entities)*['entity like ?'])
-            self.db.execute('begin')
-            self.db.execute(f'delete from knowledge where {condition}', tuple(entities))
-            self.db.execute(f'delete from labels where {condition}', tuple(entities))
-            self.db.execute(f'delete from publications where {condition}', tuple(entities))
-            self.db.execute('commit')
+            prefixes = [Apinatomy.APINATOMY_MODEL_PREFIX]
+            prefixes.extend([f'{ontology}:' for ontology in Apinatomy.CONNECTIVITY_ONTOLOGIES])
+            # Prefixes as ranges of entities, so that deletes can use each table's entity index
+            ranges = [(prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)) for prefix in prefixes]
+            with self.transaction():
+                for table in CONNECTIVITY_TABLES:
+                    self.db.executemany(f'delete from {table} where entity >= ? and entity < ?', ranges)
+        # Optionally load all local knowledge into memory
+        if (self.db is not None and prewarm
+        and self.scalar(SQL_COUNT_KNOWLEDGE) <= prewarm_limit):
+            for entity, blob in self.db.execute(SQL_SELECT_ALL_KNOWLEDGE):
+                if len(knowledge := json_loads(blob)):
+                    if 'label' not in knowledge:
+                        knowledge['label'] = entity
+                    self.__entity_knowledge[entity] = knowledge
+                    KnowledgeStore.__log_errors(entity, knowledge)
+
+    @classmethod
+    def shared(cls, store_directory=None, **kwds):
+    #=============================================
+        # Get a store that is shared with anyone else in this thread who asks
+        # for it with the same arguments; it is only closed after every one
+        # of them has closed it. Stores aren't shared between threads as a
+        # SQLite connection can only be used by the thread that opened it
+        if store_directory is not None:
+            store_directory = str(Path(store_directory).resolve())
+        key = (threading.get_ident(), store_directory, tuple(sorted(kwds.items())))
+        with cls.__shared_lock:
+            if (store := cls.__shared_stores.get(key)) is None:
+                store = cls(store_directory=store_directory, **kwds)
+                store.__shared_key = key
+                cls.__shared_stores[key] = store
+            store.__shared_count += 1
+        return store
+
+    def close(self):
+    #===============
+        with KnowledgeStore.__shared_lock:
+            if self.__shared_count > 1:
+                self.__shared_count -= 1
+                return
+            if self.__shared_key is not None:
+                KnowledgeStore.__shared_stores.pop(self.__shared_key, None)
+                self.__shared_key = None
+                self.__shared_count = 0
+        super().close()
 
     @property
     def scicrunch(self):
+        if self.__scicrunch is None and self.__scicrunch_params is not None:
+            self.__scicrunch = SciCrunch(**self.__scicrunch_params)
         return self.__scicrunch
 
     def connectivity_models(self):
     #=============================
-        if self.__scicrunch is not None:
-            models = self.__scicrunch.connectivity_models()
+        if self.scicrunch is not None:
+            models = self.scicrunch.connectivity_models()
             if self.db is not None and not self.read_only:
-                if not self.db.in_transaction:
-                    self.db.execute('begin')
-                for model, label in models.items():
-                    self.db.execute('replace into connectivity_models values (?)', (model, ))
-                    self.db.execute('replace into labels values (?, ?)', (model, label))
-                self.db.commit()
+                with self.transaction():
+                    self.db.executemany(SQL_UPSERT_CONNECTIVITY_MODEL, [(model, ) for model in models])
+                    self.db.executemany(SQL_UPSERT_LABEL, models.items())
+                self.__entity_labels.update(models)
             return models
         elif self.db is not None:
-            return {row[0]: row[1] for row in self.db.execute('''
-                select c.model, l.label from connectivity_models as c
-                    left join labels as l on c.model = l.entity order by model
-                ''')}
+            return dict(self.db.execute(SQL_SELECT_CONNECTIVITY_MODELS))
         else:
             return {}
 
     def labels(self):
     #================
         if self.db is not None:
-            return [tuple(row) for row in self.db.execute('select entity, label from labels order by entity')]
+            return [tuple(row) for row in self.db.execute(SQL_SELECT_LABELS)]
         else:
             return []
 
@@ -195,78 +461,227 @@ class KnowledgeStore(KnowledgeBase):
 
     def entity_knowledge(self, entity):
     #==================================
-        # Optionally refresh local connectivity knowledge from SciCrunch
-        if self.db is not None:
-            # Check local cache
-            knowledge = self.__entity_knowledge.get(entity, {})
-            if len(knowledge):
-                KnowledgeStore.__log_errors(entity, knowledge)
-                return knowledge
+        # Check local cache before anything else; any errors
+        # were logged when the knowledge was cached
+        if knowledge := self.__entity_knowledge.get(entity):
+            return knowledge
 
         knowledge = {}
         if self.db is not None:
             # Check our database
-            row = self.db.execute('select knowledge from knowledge where entity=?', (entity,)).fetchone()
-            if row is not None:
-                knowledge = json.loads(row[0])
-        if len(knowledge) == 0 and self.__scicrunch is not None:
+            blob = self.scalar(SQL_SELECT_KNOWLEDGE, (entity,))
+            if blob is not None:
+                knowledge = json_loads(blob)
+        if (len(knowledge) == 0 and self.scicrunch is not None
+        and len(self.__recently_unknown([entity])) == 0):
             # Consult SciCrunch if we don't know about the entity
-            knowledge = self.__scicrunch.get_knowledge(entity)
-            if 'connectivity' in knowledge:
-                phenotypes = self.__scicrunch.get_phenotypes(entity)
+            knowledge = self.__scicrunch_knowledge(entity)
+            # Make sure we have labels for each entity used for connectivity
+            self.entity_labels(KnowledgeStore.__connectivity_terms(knowledge))
+            if self.db is not None and not self.read_only:
+                with self.transaction():
+                    self.__save_knowledge(entity, knowledge)
+
+        return self.__cache_knowledge(entity, knowledge)
+
+    def entities_knowledge(self, entities):
+    #======================================
+        # Lookup knowledge for a collection of entities, querying our database
+        # in chunks and only falling back to SciCrunch for what isn't found,
+        # saving whatever SciCrunch returns in a single transaction
+        entities = list(dict.fromkeys(entities))
+        knowledge = {}
+        for entity in entities:
+            if cached := self.__entity_knowledge.get(entity):
+                knowledge[entity] = cached
+        uncached = [entity for entity in entities if entity not in knowledge]
+        for entity, blob in self.__select_entities(SQL_SELECT_KNOWLEDGE_IN, uncached):
+            if len(entity_knowledge := json_loads(blob)):
+                knowledge[entity] = self.__cache_knowledge(entity, entity_knowledge)
+        if len(knowledge) < len(entities):
+            # Concurrently fetch whatever we don't know about, which is then
+            # cached, so we don't hold a transaction open while waiting on SciCrunch
+            self.prefetch([entity for entity in entities if entity not in knowledge])
+            for entity in entities:
+                if entity not in knowledge:
+                    knowledge[entity] = self.entity_knowledge(entity)
+        return {entity: knowledge[entity] for entity in entities}
+
+    def prefetch(self, entities, max_workers=PREFETCH_WORKERS):
+    #==========================================================
+        # Concurrently fetch knowledge from SciCrunch for entities that we don't
+        # already know about, along with the terms used by their connectivity,
+        # so that subsequent lookups are local
+        if self.scicrunch is None:
+            return
+        entities = self.__unknown_entities(entities)
+        while len(entities):
+            fetched = self.scicrunch.get_knowledge_many(entities, max_workers)
+            neurons = [entity for entity, knowledge in fetched.items() if 'connectivity' in knowledge]
+            for entity, phenotypes in self.scicrunch.get_phenotypes_many(neurons, max_workers).items():
                 if len(phenotypes) > 0:
-                    knowledge['phenotypes'] = phenotypes
-                # Make sure we have labels for each entity used for connectivity
-                connectivity_terms = set()
-                for (node0, node1) in knowledge['connectivity']:
-                    connectivity_terms.update([node0[0], node1[0]])
-                    connectivity_terms.update(node0[1])
-                    connectivity_terms.update(node1[1])
-                for connectivity_term in connectivity_terms:
-                    self.label(connectivity_term)
-            if len(knowledge) > 0 and self.db is not None and not self.read_only:
-                if not self.db.in_transaction:
-                    self.db.execute('begin')
-                # Use 'long-label' if the entity's label' is the same as itself.
-                if 'label' in knowledge:
-                    if knowledge['label'] == entity and 'long-label' in knowledge:
-                        knowledge['label'] = knowledge['long-label']                # Save knowledge in our database
-                self.db.execute('replace into knowledge values (?, ?)', (entity, json.dumps(knowledge)))
-                # Save label and references in their own tables
-                if 'label' in knowledge:
-                    self.db.execute('replace into labels values (?, ?)', (entity, knowledge['label']))
-                if 'references' in knowledge:
-                    self.__update_references(entity, knowledge.get('references', []))
-                self.db.commit()
-
-        # Use the entity's value as its label if none is defined
+                    fetched[entity]['phenotypes'] = phenotypes
+            # Save everything in a single transaction
+            if self.db is not None and not self.read_only:
+                with self.transaction():
+                    for entity, knowledge in fetched.items():
+                        self.__save_knowledge(entity, knowledge)
+            connectivity_terms = set()
+            for entity, knowledge in fetched.items():
+                connectivity_terms.update(KnowledgeStore.__connectivity_terms(knowledge))
+                self.__cache_knowledge(entity, knowledge)
+            entities = self.__unknown_entities(connectivity_terms)
+
+    def __unknown_entities(self, entities):
+    #======================================
+        entities = [entity for entity in dict.fromkeys(entities)
+                        if entity not in self.__entity_knowledge]
+        known = set(row[0] for row in self.__select_entities(SQL_SELECT_ENTITIES_IN, entities))
+        known.update(self.__recently_unknown(entities))
+        return [entity for entity in entities if entity not in known]
+
+    def __recently_unknown(self, entities):
+    #======================================
+        # Entities that SciCrunch didn't know about when last asked, unless
+        # that was long enough ago to be worth asking again
+        if self.db is None or self.schema_version < 5:
+            return set()
+        since = time.time() - UNKNOWN_ENTITY_RETRY
+        return set(row[0] for row in self.__select_entities(SQL_SELECT_UNKNOWN_IN, entities, (since,)))
+
+    def __select_entities(self, sql, entities, parameters=()):
+    #=========================================================
+        # Run an ``entity in (...)`` query in chunks, yielding result rows;
+        # any other parameters come before the entities
+        if self.db is not None:
+            chunk_size = MAX_SQL_VARIABLES - len(parameters)
+            for start in range(0, len(entities), chunk_size):
+                chunk = entities[start:start+chunk_size]
+                placeholders = ', '.join(len(chunk)*['?'])
+                yield from self.db.execute(sql.format(placeholders), (*parameters, *chunk))
+
+    def __scicrunch_knowledge(self, entity):
+    #=======================================
+        knowledge = self.scicrunch.get_knowledge(entity)
+        if 'connectivity' in knowledge:
+            phenotypes = self.scicrunch.get_phenotypes(entity)
+            if len(phenotypes) > 0:
+                knowledge['phenotypes'] = phenotypes
+        return knowledge
+
+    @staticmethod
+    def __connectivity_terms(knowledge):
+    #===================================
+        return {term for (node0, node1) in knowledge.get('connectivity', [])
+                        for node in (node0, node1)
+                            for term in (node[0], *node[1])}
+
+    def __cache_knowledge(self, entity, knowledge):
+    #==============================================
+        # Use the entity's value as its label if none is defined,
+        # otherwise keep the label for ``label()``
         if 'label' not in knowledge:
             knowledge['label'] = entity
+        else:
+            self.__entity_labels[entity] = knowledge['label']
 
         # Cache local knowledge
         self.__entity_knowledge[entity] = knowledge
 
-        # Log any errors
+        # Log any errors, just the once
         KnowledgeStore.__log_errors(entity, knowledge)
 
         return knowledge
 
+    def __save_knowledge(self, entity, knowledge):
+    #=============================================
+        # NB. This must be called within a transaction
+        if len(knowledge) == 0:
+            # Remember that SciCrunch doesn't know about the entity, unless
+            # its lookup failed and so should be tried again
+            if self.schema_version >= 5 and not self.scicrunch.lookup_failed(entity):
+                self.db.execute(SQL_UPSERT_UNKNOWN, (entity, time.time()))
+            return
+        if self.schema_version >= 5:
+            self.db.execute(SQL_DELETE_UNKNOWN, (entity,))
+        # Use 'long-label' if the entity's label' is the same as itself.
+        if 'label' in knowledge:
+            if knowledge['label'] == entity and 'long-label' in knowledge:
+                knowledge['label'] = knowledge['long-label']
+        # Save knowledge in our database
+        self.db.execute(SQL_UPSERT_KNOWLEDGE, (entity, json_dumps(knowledge)))
+        # Save label and references in their own tables
+        if 'label' in knowledge:
+            self.db.execute(SQL_UPSERT_LABEL, (entity, knowledge['label']))
+        if 'references' in knowledge:
+            self.__update_references(entity, knowledge.get('references', []))
+        if 'phenotypes' in knowledge:
+            self.__update_phenotypes(entity, knowledge.get('phenotypes', []))
+
+    def phenotypes(self, entity):
+    #============================
+        if self.db is not None and self.schema_version >= 2:
+            phenotypes = self.scalars(SQL_SELECT_PHENOTYPES, (entity,))
+            if len(phenotypes):
+                return phenotypes
+        return self.entity_knowledge(entity).get('phenotypes', [])
+
     def label(self, entity):
     #=======================
+        if (label := self.__entity_labels.get(entity)) is not None:
+            return label
         if self.db is not None:
-            row = self.db.execute('select label from labels where entity=?', (entity,)).fetchone()
-            if row is not None:
-                return row[0]
+            label = self.scalar(SQL_SELECT_LABEL, (entity,))
+            if label is not None:
+                self.__entity_labels[entity] = label
+                return label
         knowledge = self.entity_knowledge(entity)
+        self.__entity_labels[entity] = knowledge['label']
         return knowledge['label']
 
+    def entity_labels(self, entities):
+    #=================================
+        # Lookup labels for a collection of entities, querying our database
+        # in chunks and only looking up knowledge for what isn't found
+        entities = list(dict.fromkeys(entities))
+        labels = {entity: self.__entity_labels[entity] for entity in entities
+                    if entity in self.__entity_labels}
+        uncached = [entity for entity in entities if entity not in labels]
+        for entity, label in self.__select_entities(SQL_SELECT_LABELS_IN, uncached):
+            if label is not None:
+                self.__entity_labels[entity] = labels[entity] = label
+        if len(labels) < len(entities):
+            # As for ``entities_knowledge()``, look up what's missing before saving it
+            self.prefetch([entity for entity in entities if entity not in labels])
+            for entity in entities:
+                if entity not in labels:
+                    labels[entity] = self.label(entity)
+        return {entity: labels[entity] for entity in entities}
+
     def __update_references(self, entity, references):
     #===============================================
+        # NB. This must be called within a transaction
         if self.db is not None:
-            with self.db:
-                self.db.execute('delete from publications where entity = ?', (entity, ))
-                self.db.executemany('insert into publications(entity, publication) values (?, ?)',
-                    ((entity, reference) for reference in references))
+            # Only write what has changed
+            existing = set(self.scalars(SQL_SELECT_PUBLICATIONS, (entity, )))
+            references = set(references)
+            if references != existing:
+                self.db.executemany(SQL_DELETE_PUBLICATION,
+                    ((entity, reference) for reference in existing - references))
+                self.db.executemany(SQL_INSERT_PUBLICATION,
+                    ((entity, reference) for reference in references - existing))
+
+    def __update_phenotypes(self, entity, phenotypes):
+    #===============================================
+        # NB. This must be called within a transaction
+        if self.db is not None:
+            self.db.execute(SQL_DELETE_PHENOTYPES, (entity, ))
+            self.db.executemany(SQL_INSERT_PHENOTYPE,
+                ((entity, phenotype) for phenotype in phenotypes))
 
 #===============================================================================
 
+def get_store(store_directory=None, **kwds):
+    return KnowledgeStore.shared(store_directory, **kwds)
+
+#===============================================================================
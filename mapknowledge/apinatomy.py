@@ -27,9 +27,12 @@
 #
 #===============================================================================
 
+from collections import Counter
+from contextlib import contextmanager
+from functools import lru_cache
+
 import networkx as nx
 import rdflib
-from rdflib.extras import external_graph_libs as egl
 
 #===============================================================================
 
@@ -40,7 +43,7 @@ from .utils import log
 # Layers shouldn't be resolving to
 # ``spinal cord``, etc. nor to ``None``.
 # A SCKAN issue
-EXCLUDED_LAYERS = (
+EXCLUDED_LAYERS = frozenset([
     None,
     'UBERON:0000010',      # peripheral nervous system
     'UBERON:0000178',      # blood
@@ -51,7 +54,10 @@ EXCLUDED_LAYERS = (
     'UBERON:0003714',      # neural tissue
     'UBERON:0005844',      # spinal cord segment
     'UBERON:0016549',      # cns white matter
-)
+])
+
+# The keys of a plain OBO graph edge, i.e. one without any metadata
+OBO_EDGE_KEYS = frozenset(['sub', 'pred', 'obj'])
 
 #===============================================================================
 
@@ -59,6 +65,9 @@ class PyOntUtilsEdge(tuple):
     """ Expansion of curies must happen before construction if it is going to
         happen at all. The expansion rule must be known beforehand. """
 
+    # Edges are created in bulk so don't give each one a ``__dict__``
+    __slots__ = ()
+
     @classmethod
     def fromNx(cls, edge):
         s, o, p = [e.toPython() if isinstance(e, rdflib.URIRef) else e
@@ -71,7 +80,6 @@ class PyOntUtilsEdge(tuple):
     def fromOboGraph(cls, blob):
         t = blob['sub'], blob['pred'], blob['obj']
         self = cls(t)
-        self._blob = blob
         return self
 
     @property
@@ -95,13 +103,14 @@ class PyOntUtilsEdge(tuple):
         return tuple(e if isinstance(e, rdflib.URIRef) else rdflib.URIRef(e) for e in self)
 
     def asOboGraph(self):
-        if not hasattr(self, '_blob'):
-            self._blob = {k:e for k, e in zip(('sub', 'pred', 'obj'), self)}
-        return self._blob
+        return {k:e for k, e in zip(('sub', 'pred', 'obj'), self)}
 
 #===============================================================================
 
 class nifstd:
+    # Caches of results derived from blobs that are in a ``caching()`` block, keyed by ``id(blob)``
+    __blob_caches = {}
+
     @staticmethod
     def sub(edge, match=None):
         return edge['sub'] == match if match is not None else edge['sub']
@@ -118,35 +127,104 @@ class nifstd:
     def ematch(blob, select, match, *matches, matchf=lambda ms: True):
         return [edge for edge in blob['edges'] if select(edge, match) and matchf(matches)]
 
+    @staticmethod
+    @contextmanager
+    def caching(blob):
+        """ cache results derived from ``blob`` within the block; nothing is added to ``blob`` """
+        key = id(blob)
+        if key in nifstd.__blob_caches:   # already caching
+            yield blob
+            return
+        nifstd.__blob_caches[key] = None
+        try:
+            yield blob
+        finally:
+            del nifstd.__blob_caches[key]
+
+    @staticmethod
+    def cache(blob, name):
+        """ a named cache of results derived from ``blob``, for as long as
+            ``blob['edges']`` isn't reassigned or changes length. Outside
+            of a ``caching()`` block this is a new, empty, dictionary """
+        key = id(blob)
+        if key not in nifstd.__blob_caches:
+            return {}
+        edges = blob['edges']
+        if (caches := nifstd.__blob_caches[key]) is None or caches[0] is not edges or caches[1] != len(edges):
+            caches = nifstd.__blob_caches[key] = (edges, len(edges), {})
+        return caches[2].setdefault(name, {})
+
+    @staticmethod
+    def subject_edges(blob, subject):
+        """ edges whose subject is ``subject``, indexed when in a ``caching()`` block """
+        if id(blob) not in nifstd.__blob_caches:
+            return [edge for edge in blob['edges'] if edge['sub'] == subject]
+        by_sub = nifstd.cache(blob, 'by_sub')
+        if not by_sub:
+            for edge in blob['edges']:
+                by_sub.setdefault(edge['sub'], []).append(edge)
+        return by_sub.get(subject, [])
+
+    @staticmethod
+    def predicate_edges(blob, predicate):
+        """ edges with ``predicate``, indexed when in a ``caching()`` block """
+        if id(blob) not in nifstd.__blob_caches:
+            return [edge for edge in blob['edges'] if edge['pred'] == predicate]
+        by_pred = nifstd.cache(blob, 'by_pred')
+        if not by_pred:
+            for edge in blob['edges']:
+                by_pred.setdefault(edge['pred'], []).append(edge)
+        return by_pred.get(predicate, [])
+
+    @staticmethod
+    def walk(blob, start, visit):
+        """ depth first from ``start``, calling ``visit`` for each edge out of a node
+            and walking on from the node it returns, unless that is already on the path """
+        path = [start]
+        stack = [iter(nifstd.subject_edges(blob, start))]
+        while stack:
+            for edge in stack[-1]:
+                if (node := visit(edge)) is not None and node not in path:
+                    path.append(node)
+                    stack.append(iter(nifstd.subject_edges(blob, node)))
+                    break
+            else:
+                stack.pop()
+                path.pop()
+
     @staticmethod
     def listIn(container, maybe_contained, *, strict=True):
         """ strictly sublists no equality here """
         lc = len(container)
         lmc = len(maybe_contained)
         if lc > lmc or not strict and lc == lmc:
-            z = maybe_contained[0]
-            if z in container:
-                substart = container.index(z)
-                subcontained = maybe_contained[1:]
-                if not subcontained:
-                    return substart
-                ssp1 = substart + 1
-                subcontainer = container[ssp1:]
-                maybe = nifstd.listIn(subcontainer, subcontained, strict=False)
-                if maybe is None or maybe > 0:
-                    maybe = nifstd.listIn(subcontainer, maybe_contained, strict=False)
-                    if maybe is not None:
-                        return ssp1 + maybe
-                else:
-                    return substart
+            for i in range(lc - lmc + 1):
+                if all(container[i + k] == maybe_contained[k] for k in range(lmc)):
+                    return i
+
+    @staticmethod
+    def chains(graph, start, length):
+        """ simple paths of ``length`` edges from ``start``, as ``nx.all_simple_paths()``
+            gives them for a multigraph, i.e. once for each combination of parallel edges """
+        path = [start]
+        def walk(node):
+            for _, child in graph.out_edges(node):
+                if child not in path:
+                    path.append(child)
+                    if len(path) > length:
+                        yield list(path)
+                    else:
+                        yield from walk(child)
+                    path.pop()
+        return walk(start)
 
     @staticmethod
     def zap(ordered_nodes, predicates, oe2, blob):
         """ don't actually zap, wait until the end so that all
             deletions happen after all additions """
-        e = PyOntUtilsEdge((ordered_nodes[0].toPython(),
+        e = PyOntUtilsEdge((ordered_nodes[0],
                 '-'.join(predicates),
-                ordered_nodes[-1].toPython()))
+                ordered_nodes[-1]))
         new_e = e.asOboGraph()
         blob['edges'].append(new_e)
         to_remove = [e.asOboGraph() for e in oe2]
@@ -155,9 +233,16 @@ class nifstd:
     @staticmethod
     def simplify(collapse, blob):
         to_remove = []
-        for coll in collapse:
-            exclude = set(p for p in coll)
-            candidates = [e for e in blob['edges'] if e['pred'] in exclude]
+        # index candidate edges for each collapse in a single pass over the edges
+        collapse_preds = {}
+        for n, coll in enumerate(collapse):
+            for p in set(coll):
+                collapse_preds.setdefault(p, []).append(n)
+        collapse_candidates = [[] for coll in collapse]
+        for e in blob['edges']:
+            for n in collapse_preds.get(e['pred'], []):
+                collapse_candidates[n].append(e)
+        for coll, candidates in zip(collapse, collapse_candidates):
             for c in candidates:
                 # make sure we can remove the edges later
                 # if they have meta the match will fail
@@ -165,21 +250,22 @@ class nifstd:
                     c.pop('meta')
             if candidates:
                 edges = [PyOntUtilsEdge.fromOboGraph(c) for c in candidates]
-                g = rdflib.Graph()
-                for e in edges: g.add(e.asRdf())
-                nxg = egl.rdflib_to_networkx_multidigraph(g)
+                # edges are keyed by predicate, so duplicates are only added once
+                nxg = nx.MultiDiGraph()
+                nxg.add_edges_from((e.s, e.o, e.p, {}) for e in edges)
                 connected = list(nx.weakly_connected_components(nxg))  # FIXME may not be minimal
-                ends = [e.asRdf()[-1] for e in edges if e.p == coll[-1]]
+                ends = [e.o for e in edges if e.p == coll[-1]]
                 for c in connected:
                     #log.debug('\n' + pformat(c))
                     nxgt = nx.MultiDiGraph()
                     nxgt.add_edges_from(nxg.edges(c, keys=True))
-                    ordered_nodes = list(nx.topological_sort(nxgt))
+                    # walk chains of ``len(coll)`` edges from each node, keeping a
+                    # path once for each time its last node is listed as an end
+                    end_counts = Counter(e for e in ends if e in c)
                     paths = [p
                              for n in nxgt.nodes()
-                             for e in ends
-                             for p in list(nx.all_simple_paths(nxgt, n, e))
-                             if len(p) == len(coll) + 1]
+                             for p in nifstd.chains(nxgt, n, len(coll))
+                             for _ in range(end_counts[p[-1]])]
                     for path in sorted(paths):
                         ordered_edges = nxgt.edges(path, keys=True)
                         oe2 = [PyOntUtilsEdge.fromNx(e) for e in ordered_edges if all([n in path for n in e[:2]])]
@@ -199,9 +285,18 @@ class nifstd:
                                     oe2 = oe2[i:j]
                                     predicates = predicates[i:j]
                                     to_remove.extend(nifstd.zap(npath, predicates, oe2, blob))
-        for r in to_remove:
-            if r in blob['edges']:
-                blob['edges'].remove(r)
+        # remove the first matching edge for each edge in ``to_remove``
+        # in a single pass, instead of searching the list for each
+        remove_counts = Counter((r['sub'], r['pred'], r['obj']) for r in to_remove)
+        edges = []
+        for e in blob['edges']:
+            if e.keys() == OBO_EDGE_KEYS:
+                key = (e['sub'], e['pred'], e['obj'])
+                if remove_counts[key] > 0:
+                    remove_counts[key] -= 1
+                    continue
+            edges.append(e)
+        blob['edges'] = edges
         #log.debug('\n' + pformat(blob['edges']))
         return blob  # note that this is in place modification so sort of supruflous
 
@@ -228,6 +323,26 @@ class Apinatomy:
     references = 'apinatomy:references'
     topology_s = 'apinatomy:topology*'
 
+    # Predicates as bits, so an edge can be tested against several at once
+    PRED_BITS = {p: 1 << n for n, p in enumerate([
+        cloneOf, endsIn, fasciculatesIn, internalIn, layerIn, ontologyTerms,
+        inheritedExternal, inheritedExternal_s, inheritedOntologyTerms, inheritedOntologyTerms_s])}
+    OTHER_PRED_BIT = 1 << len(PRED_BITS)
+
+    @staticmethod
+    def pred_bits(edge):
+        return Apinatomy.PRED_BITS.get(edge['pred'], Apinatomy.OTHER_PRED_BIT)
+
+    @staticmethod
+    def pred_mask(*predicates):
+        # NB. ``nifstd.pred(edge, None)`` is true for any edge
+        if None in predicates:
+            return -1
+        mask = 0
+        for p in predicates:
+            mask |= Apinatomy.PRED_BITS[p]
+        return mask
+
     @staticmethod
     def getiot(blob):
         # ie and iot are mutually exclusive
@@ -235,13 +350,21 @@ class Apinatomy:
             if e['pred'] in (Apinatomy.inheritedExternal, Apinatomy.inheritedOntologyTerms):
                 return e['pred']
 
+    @staticmethod
+    def iot_predicates(blob):
+        cache = nifstd.cache(blob, 'iot_predicates')
+        if not cache:
+            iot_predicate = Apinatomy.getiot(blob)
+            if iot_predicate == Apinatomy.inheritedOntologyTerms:
+                iot_predicate_s = Apinatomy.inheritedOntologyTerms_s
+            else:
+                iot_predicate_s = Apinatomy.inheritedExternal_s
+            cache['predicates'] = (iot_predicate, iot_predicate_s)
+        return cache['predicates']
+
     @staticmethod
     def deblob(blob, remove_converge=False):
-        iot_predicate = Apinatomy.getiot(blob)
-        if iot_predicate == Apinatomy.inheritedOntologyTerms:
-            iot_predicate_s = Apinatomy.inheritedOntologyTerms_s
-        else:
-            iot_predicate_s = Apinatomy.inheritedExternal_s
+        iot_predicate, iot_predicate_s = Apinatomy.iot_predicates(blob)
 
         # FIXME I think we may be over or under simplifying just a bit
         # somehow getting double links at the end of the chain
@@ -249,14 +372,12 @@ class Apinatomy:
         # FIXME issue here is that chain roots -> levels goes to all levels of the chain which is NOT
         # what we want, TODO need to filter out cases where the target of levels is pointed to by next
         # this is implemented downstream from here I think
+        # NB. This matches on objects, so find the targets of next just once
+        next_objects = {e['obj'] for e in blob['edges'] if e['pred'] == 'apinatomy:next'}
         blob['edges'] = [
-            e for e in blob['edges'] if not nifstd.pred(e, 'apinatomy:levels') or
-            (nifstd.pred(e, 'apinatomy:levels') and
-             not nifstd.ematch(
-                blob,
-                lambda ei, m: (nifstd.obj(ei, m) and nifstd.pred(ei, 'apinatomy:next')),
-                nifstd.obj(e))
-        )]
+            e for e in blob['edges'] if e['pred'] != 'apinatomy:levels' or
+            e['obj'] not in next_objects
+        ]
 
         #[e for e in blob['edges'] if pred(e, 'apinatomy:rootOf')]
 
@@ -268,9 +389,15 @@ class Apinatomy:
              ['apinatomy:cloneOf', iot_predicate],
              ['apinatomy:conveyingLyph', iot_predicate],],
             blob)
-        edges = blob['edges']
         nindex = {n['id']:n for n in blob['nodes']}  # FIXME silent errors ;_;
-        for e in edges:
+        process_types = (Apinatomy.axon, Apinatomy.dendrite)
+        # rename, filter and deduplicate the simplified edges in a single pass
+        edges = [] if remove_converge else blob['edges']
+        unique = {}
+        somas = []
+        terms = []
+        ordering_edges = []
+        for e in blob['edges']:
             if e['pred'] == 'apinatomy:nextChainStartLevels':
                 e['pred'] = 'apinatomy:next'
             if e['pred'] in (
@@ -284,49 +411,75 @@ class Apinatomy:
                     f'apinatomy:conveyingLyph-{iot_predicate}',
                     f'apinatomy:cloneOf-{iot_predicate}',):
                 e['pred'] = iot_predicate_s
-            if nifstd.pred(e, Apinatomy.topology_s):
+            if e['pred'] == Apinatomy.topology_s:
                 # move topology to be a property not a node to make the layout cleaner
-                nindex[nifstd.sub(e)]['topology'] = nifstd.obj(e)
-
-        if remove_converge:
-            # remove topology edges
-            edges = blob['edges'] = [e for e in edges if not nifstd.pred(e, top)]
-            # remove process type edges
-            edges = blob['edges'] = [e for e in edges if not (nifstd.obj(e, Apinatomy.axon)
-                                                           or nifstd.obj(e, Apinatomy.dendrite))]
-
-        blob['edges'] = [dict(s) for s in set(frozenset({k:v for k, v in d.items()
-                                                         if k != 'meta'}.items()) for d in blob['edges'])]
+                nindex[e['sub']]['topology'] = e['obj']
+
+            if remove_converge:
+                # remove topology and process type edges
+                if e['pred'] == Apinatomy.topology_s or e['obj'] in process_types:
+                    continue
+                edges.append(e)
+
+            # edges are identified by (sub, pred, obj), so keep the first of any duplicates
+            e.pop('meta', None)
+            unique.setdefault((e['sub'], e['pred'], e['obj']), e)
+
+            if e['pred'] == Apinatomy.internalIn:
+                somas.append(e)
+            elif e['pred'] == Apinatomy.ontologyTerms:
+                terms.append(e)
+            elif e['pred'] == Apinatomy.next:
+                ordering_edges.append(e)
+        blob['edges'] = list(unique.values())
 
         def sekey(e):
-            s, p, o = nifstd.sub(e), nifstd.pred(e), nifstd.obj(e)
+            s, p, o = e['sub'], e['pred'], e['obj']
             iot = p != Apinatomy.ontologyTerms
             return iot, p, s, o
 
-        blob['edges'] = sorted(blob['edges'], key=sekey)
-        sos = set(sov for e in blob['edges'] for sov in (e['sub'], e['obj']))
+        # NB. keys are computed once per edge, not per comparison, and the
+        # deduplicated list is ours so can be sorted in place
+        blob['edges'].sort(key=sekey)
+        sos = {sov for s, _, o in unique for sov in (s, o)}
         blob['nodes'] = [n for n in blob['nodes'] if n['id'] in sos]
-        somas = [e for e in edges if e['pred'] == Apinatomy.internalIn]
-        terms = [e for e in edges if e['pred'] == Apinatomy.ontologyTerms]
-        ordering_edges = [e for e in edges if e['pred'] == Apinatomy.next]
+        # the node index is what's left of ``nindex``
+        nifstd.cache(blob, 'node_index').update((node_id, n) for node_id, n in nindex.items() if node_id in sos)
         return blob, edges, somas, terms, ordering_edges
 
+    @staticmethod
+    def node_index(blob):
+        index = nifstd.cache(blob, 'node_index')
+        if not index:
+            index.update({n['id']:n for n in blob['nodes']})
+        return index
+
     @staticmethod
     def isLayer(blob, match):
-        return nifstd.ematch(
-            blob,
-            lambda e, m: (nifstd.sub(e, m) and nifstd.pred(e, Apinatomy.layerIn)),
-            match)
+        layers = nifstd.cache(blob, 'layers')
+        if not layers:
+            layers.update((e['sub'], True) for e in nifstd.predicate_edges(blob, Apinatomy.layerIn))
+        return match in layers
 
     @staticmethod
     def reclr(blob, start_link):
+        # neurons share regions so we are often asked for the same start
+        cache = nifstd.cache(blob, 'reclr')
+        if start_link not in cache:
+            cache[start_link] = tuple(Apinatomy.__reclr(blob, start_link))
+        return list(cache[start_link])
+
+    @staticmethod
+    def __reclr(blob, start_link):
         # recurse up the hierarchy until fasIn endIn intIn terminates
-        iot_predicate = Apinatomy.getiot(blob)
-        if iot_predicate == Apinatomy.inheritedOntologyTerms:
-            iot_predicate_s = Apinatomy.inheritedOntologyTerms_s
-        else:
-            iot_predicate_s = Apinatomy.inheritedExternal_s
+        iot_predicate, iot_predicate_s = Apinatomy.iot_predicates(blob)
+
+        clone_mask = Apinatomy.pred_mask(Apinatomy.cloneOf)
+        term_mask = Apinatomy.pred_mask(Apinatomy.ontologyTerms, iot_predicate, iot_predicate_s)
+        region_mask = Apinatomy.pred_mask(Apinatomy.layerIn, Apinatomy.fasciculatesIn,
+                                          Apinatomy.endsIn, Apinatomy.internalIn)
 
+        nodes = Apinatomy.node_index(blob)
         collect = []
         layer = []
         col = True
@@ -334,14 +487,13 @@ class Apinatomy:
         def select_ext(e, m, collect=collect):
             nonlocal col
             nonlocal layer
-            if nifstd.sub(e, m):
-                if nifstd.pred(e, Apinatomy.cloneOf):  # should be zapped during simplify
+            if e['sub'] == m:
+                bits = Apinatomy.pred_bits(e)
+                if bits & clone_mask:  # should be zapped during simplify
                     log.warning(f'should not have hit a cloneOf case {e}')
-                    return nifstd.ematch(blob, select_ext, nifstd.obj(e))
-                if (nifstd.pred(e, Apinatomy.ontologyTerms)
-                 or nifstd.pred(e, iot_predicate)
-                 or nifstd.pred(e, iot_predicate_s)):
-                    external = nifstd.obj(e)
+                    return match_ext(e['obj'])
+                if bits & term_mask:
+                    external = e['obj']
                     if col:
                         if layer:
                             if len(layer) > 1:  # ensure ontologyTerms get priority
@@ -356,69 +508,63 @@ class Apinatomy:
                                 l = layer.pop()
                         else:
                             l = None
-                        r = [b for b in blob['nodes'] if b['id'] == external][0]['id']  # if this is empty we are in big trouble
+                        r = nodes[external]['id']  # if this is missing we are in big trouble
                         collect.append((l, r))
                     else:
-                        l = [b for b in blob['nodes'] if b['id'] == external][0]['id']
+                        l = nodes[external]['id']
                         layer.append(l)
                     return external
 
-        def select(e, m):
+        def match_ext(m):
+            return [e for e in nifstd.subject_edges(blob, m) if select_ext(e, m)]
+
+        def visit(e):
             nonlocal col
-            if nifstd.sub(e, m):
-                if (nifstd.pred(e, Apinatomy.layerIn)
-                 or nifstd.pred(e, Apinatomy.fasciculatesIn)
-                 or nifstd.pred(e, Apinatomy.endsIn)
-                 or nifstd.pred(e, Apinatomy.internalIn)):
-                    col = not Apinatomy.isLayer(blob, nifstd.obj(e))
-                    nifstd.ematch(blob, select_ext, nifstd.obj(e))
-                    nifstd.ematch(blob, select, nifstd.obj(e))
-
-        nifstd.ematch(blob, select, start_link)
+            if Apinatomy.pred_bits(e) & region_mask:
+                col = not Apinatomy.isLayer(blob, e['obj'])
+                match_ext(e['obj'])
+                return e['obj']
+
+        nifstd.walk(blob, start_link, visit)
         return collect
 
     @staticmethod
     def layer_regions(blob, start):
-        iot_predicate = Apinatomy.getiot(blob)
-        if iot_predicate == Apinatomy.inheritedOntologyTerms:
-            iot_predicate_s = Apinatomy.inheritedOntologyTerms_s
-        else:
-            iot_predicate_s = Apinatomy.inheritedExternal_s
-
-        direct = [nifstd.obj(t) for t in
-                  nifstd.ematch(blob, (lambda e, m: nifstd.sub(e, m)
-                                    and (nifstd.pred(e, Apinatomy.internalIn)
-                                      or nifstd.pred(e, Apinatomy.endsIn)
-                                      or nifstd.pred(e, Apinatomy.fasciculatesIn))),
-                             start)]
-        layers = [nifstd.obj(t) for d in direct for t in
-                  nifstd.ematch(blob, (lambda e, m: nifstd.sub(e, m)
-                                    and Apinatomy.isLayer(blob, m)
-                                    and (nifstd.pred(e, iot_predicate)
-                                      or nifstd.pred(e, iot_predicate_s)
-                                      or nifstd.pred(e, Apinatomy.ontologyTerms))),
-                             d)]
+        # nodes appear in many next pairs
+        cache = nifstd.cache(blob, 'layer_regions')
+        if start not in cache:
+            cache[start] = Apinatomy.__layer_regions(blob, start)
+        return cache[start]
+
+    @staticmethod
+    def __layer_regions(blob, start):
+        iot_predicate, iot_predicate_s = Apinatomy.iot_predicates(blob)
+
+        region_mask = Apinatomy.pred_mask(Apinatomy.internalIn, Apinatomy.endsIn, Apinatomy.fasciculatesIn)
+        # NB. A mask, as ``iot_predicate`` is None (and then matches any edge) if the blob has no iot edges
+        term_mask = Apinatomy.pred_mask(iot_predicate, iot_predicate_s, Apinatomy.ontologyTerms)
+        layer_mask = Apinatomy.pred_mask(Apinatomy.layerIn)
+        direct = [e['obj'] for e in nifstd.subject_edges(blob, start)
+                    if Apinatomy.pred_bits(e) & region_mask]
+        # a single pass over each region's edges finds its terms and layers
+        layers = []
+        regions = []
+        ldir = []
+        for d in direct:
+            terms = layers if Apinatomy.isLayer(blob, d) else regions
+            for e in nifstd.subject_edges(blob, d):
+                # NB. Not exclusive, as ``term_mask`` matches any edge when there's no iot
+                bits = Apinatomy.pred_bits(e)
+                if bits & term_mask:
+                    terms.append(e['obj'])
+                if bits & layer_mask:
+                    ldir.append(e['obj'])
         layers = [l for l in layers if l not in EXCLUDED_LAYERS]  # XXX temp fix
         lregs = []
         if layers:
-            ldir = [nifstd.obj(t) for d in direct for t in
-                    nifstd.ematch(blob, (lambda e, m: nifstd.sub(e, m)
-                                      and nifstd.pred(e, Apinatomy.layerIn)),
-                               d)]
-            lregs = [nifstd.obj(t) for d in ldir for t in
-                     nifstd.ematch(blob, (lambda e, m: nifstd.sub(e, m)
-                                       and not Apinatomy.isLayer(blob, m)
-                                       and (nifstd.pred(e, iot_predicate)
-                                         or nifstd.pred(e, iot_predicate_s)
-                                         or nifstd.pred(e, Apinatomy.ontologyTerms))),
-                                d)]
-        regions = [nifstd.obj(t) for d in direct for t in
-                   nifstd.ematch(blob, (lambda e, m: nifstd.sub(e, m)
-                                     and not Apinatomy.isLayer(blob, m)
-                                     and (nifstd.pred(e, iot_predicate)
-                                       or nifstd.pred(e, iot_predicate_s)
-                                       or nifstd.pred(e, Apinatomy.ontologyTerms))),
-                                 d)]
+            lregs = [e['obj'] for d in ldir if not Apinatomy.isLayer(blob, d)
+                        for e in nifstd.subject_edges(blob, d)
+                            if Apinatomy.pred_bits(e) & term_mask]
 
         lrs = Apinatomy.reclr(blob, start)
 
@@ -428,43 +574,57 @@ class Apinatomy:
 
     @staticmethod
     def find_terminals(blob, type):
-        iot_predicate = Apinatomy.getiot(blob)
-        if iot_predicate == Apinatomy.inheritedOntologyTerms:
-            iot_predicate_s = Apinatomy.inheritedOntologyTerms_s
-        else:
-            iot_predicate_s = Apinatomy.inheritedExternal_s
+        iot_predicate, iot_predicate_s = Apinatomy.iot_predicates(blob)
 
-        return [es for es in blob['edges']
-                if nifstd.pred(es, iot_predicate_s)
-                and nifstd.obj(es, type)
-                and nifstd.ematch(blob, (lambda e, m: nifstd.sub(e, m)
-                                         and nifstd.pred(e, Apinatomy.topology_s)
-                                         and nifstd.obj(e, Apinatomy.BAG)),
-                                  nifstd.sub(es))]
+        return [es for es in nifstd.predicate_edges(blob, iot_predicate_s)
+                if es['obj'] == type
+                and any(e['pred'] == Apinatomy.topology_s and e['obj'] == Apinatomy.BAG
+                        for e in nifstd.subject_edges(blob, es['sub']))]
 
     @staticmethod
     def find_region(blob, edge):
+        cache = nifstd.cache(blob, 'find_region')
+        if (start := edge['sub']) not in cache:
+            cache[start] = tuple(Apinatomy.__find_region(blob, edge))
+        return list(cache[start])
+
+    @staticmethod
+    def __find_region(blob, edge):
+        region_mask = Apinatomy.pred_mask(Apinatomy.layerIn, Apinatomy.fasciculatesIn, Apinatomy.endsIn)
+        term_mask = Apinatomy.pred_mask(Apinatomy.ontologyTerms)
+        # NB. keeps every node with a region's id, not just the last one
+        nodes = nifstd.cache(blob, 'nodes_by_id')
+        if not nodes:
+            for n in blob['nodes']:
+                nodes.setdefault(n['id'], []).append(n)
         collect = []
-        def select(e, m, collect=collect):
-            if nifstd.sub(e, m):
-                if (nifstd.pred(e, Apinatomy.layerIn)
-                 or nifstd.pred(e, Apinatomy.fasciculatesIn)
-                 or nifstd.pred(e, Apinatomy.endsIn)):
-                    return nifstd.ematch(blob, select, nifstd.obj(e))
-                elif nifstd.pred(e, Apinatomy.ontologyTerms):
-                    region = nifstd.obj(e)
-                    collect.extend([b for b in blob['nodes'] if b['id'] == region])
-                    return region
-        nifstd.ematch(blob, select, nifstd.sub(edge))
+        def visit(e):
+            bits = Apinatomy.pred_bits(e)
+            if bits & region_mask:
+                return e['obj']
+            elif bits & term_mask:
+                collect.extend(nodes.get(e['obj'], []))
+        nifstd.walk(blob, edge['sub'], visit)
         return collect
 
     @staticmethod
-    def find_region_layer(blob, edge, bindex):  # XXX did I just reimplement a worse reclr ???
-        iot_predicate = Apinatomy.getiot(blob)
-        if iot_predicate == Apinatomy.inheritedOntologyTerms:
-            iot_predicate_s = Apinatomy.inheritedOntologyTerms_s
-        else:
-            iot_predicate_s = Apinatomy.inheritedExternal_s
+    def find_region_layer(blob, edge, bindex=None):
+        # NB. Errors aren't cached as their message includes the edge
+        cache = nifstd.cache(blob, 'find_region_layer')
+        if (start := edge['sub']) not in cache:
+            if bindex is None:
+                bindex = Apinatomy.node_index(blob)
+            cache[start] = tuple(Apinatomy.__find_region_layer(blob, edge, bindex))
+        return list(cache[start])
+
+    @staticmethod
+    def __find_region_layer(blob, edge, bindex):  # XXX did I just reimplement a worse reclr ???
+        iot_predicate, iot_predicate_s = Apinatomy.iot_predicates(blob)
+
+        layer_mask = Apinatomy.pred_mask(Apinatomy.layerIn)
+        region_mask = Apinatomy.pred_mask(Apinatomy.fasciculatesIn, Apinatomy.endsIn)
+        term_mask = Apinatomy.pred_mask(Apinatomy.ontologyTerms)
+        iot_mask = Apinatomy.pred_mask(iot_predicate, iot_predicate_s)
 
         _nonelayer = False
         collect = []
@@ -472,37 +632,27 @@ class Apinatomy:
         layers_ies = []
         donel = set()
         doner = set()
-        def select_term(e, m, layers=layers):
-            if nifstd.sub(e, m):
-                if (nifstd.pred(e, Apinatomy.ontologyTerms)
-                    or nifstd.pred(e, iot_predicate)
-                    or nifstd.pred(e, iot_predicate_s)):
-                    layer = nifstd.obj(e)
-                    if layer not in donel:
+        def visit(e):
+            bits = Apinatomy.pred_bits(e)
+            if bits & layer_mask:
+                # we're at a layer, so collect its terms
+                for t in nifstd.subject_edges(blob, e['sub']):
+                    term_bits = Apinatomy.pred_bits(t)
+                    if term_bits & (term_mask | iot_mask) and (layer := t['obj']) not in donel:
                         donel.add(layer)
-                        if (nifstd.pred(e, iot_predicate)
-                            or nifstd.pred(e, iot_predicate_s)):
+                        if term_bits & iot_mask:
                             layers_ies.append(bindex[layer])
                         else:
                             layers.append(bindex[layer])
-                    return layer
-
-        def select(e, m, collect=collect):
-            if nifstd.sub(e, m):
-                if nifstd.pred(e, Apinatomy.layerIn):
-                    # we're at a layer
-                    nifstd.ematch(blob, select_term, nifstd.sub(e))
-                    return nifstd.ematch(blob, select, nifstd.obj(e))
-                elif (nifstd.pred(e, Apinatomy.fasciculatesIn)
-                      or nifstd.pred(e, Apinatomy.endsIn)):
-                    return nifstd.ematch(blob, select, nifstd.obj(e))
-                elif nifstd.pred(e, Apinatomy.ontologyTerms):
-                    region = nifstd.obj(e)
-                    if region not in doner:
-                        doner.add(region)
-                        collect.append(bindex[region])
-                    return region
-        nifstd.ematch(blob, select, nifstd.sub(edge))
+                return e['obj']
+            elif bits & region_mask:
+                return e['obj']
+            elif bits & term_mask:
+                region = e['obj']
+                if region not in doner:
+                    doner.add(region)
+                    collect.append(bindex[region])
+        nifstd.walk(blob, edge['sub'], visit)
         #pprint((collect, layers, layers_ies))
         if collect and not layers and not layers_ies:
             layers = [None]
@@ -512,10 +662,8 @@ class Apinatomy:
 
         # this is a temporary hack, it will go away when inheritedExternals and
         # inheritedOntologyTerms are differentiated in the next release PNS/CNS
-        lids = [l['id'] for l in layers if l is not None]
-        for bad in EXCLUDED_LAYERS:
-            if bad in lids:
-                layers = [l for l in layers if l is None or l['id'] != bad]
+        if not EXCLUDED_LAYERS.isdisjoint(l['id'] for l in layers if l is not None):
+            layers = [l for l in layers if l is None or l['id'] not in EXCLUDED_LAYERS]
 
         # if we removed all layers because they were bad restore [None] so counts match
         if not layers and (_nonelayer or layers_ies):
@@ -537,7 +685,7 @@ class Apinatomy:
                 for region in Apinatomy.find_region(blob, es)]
 
     @staticmethod
-    def find_terminal_region_layers(blob, type, bindex):
+    def find_terminal_region_layers(blob, type, bindex=None):
         try:
             return {
                 'terminal-regions':
@@ -554,6 +702,13 @@ class Apinatomy:
     @staticmethod
     def parse_connectivity(data):
     #============================
+        # Indexes and results derived from the blob are shared by the traversals
+        with nifstd.caching(data):
+            return Apinatomy.__parse_connectivity(data)
+
+    @staticmethod
+    def __parse_connectivity(data):
+    #==============================
         def anatomical_layer(pair_list):
             layers = []
             if pair_list[0][0] is None:
@@ -568,42 +723,63 @@ class Apinatomy:
 
         blob, *_ = Apinatomy.deblob(data)
 
-        starts = [nifstd.obj(e) for e in blob['edges'] if nifstd.pred(e, Apinatomy.lyphs)]
-        nexts = [(nifstd.sub(t), nifstd.obj(t)) for start in starts for t in
-                  nifstd.ematch(blob, (lambda e, m: nifstd.pred(e, Apinatomy.next)
-                                              or nifstd.pred(e, Apinatomy.next_s)), None)]
-        nodes = sorted(set([tuple([Apinatomy.layer_regions(blob, e) for e in p]) for p in nexts]))
+        # NB. these were once repeated for every lyph start, which only duplicated
+        # pairs as they are made into a set below, so just check there are starts
+        has_starts = len(nifstd.predicate_edges(blob, Apinatomy.lyphs)) > 0
+        next_predicates = (Apinatomy.next, Apinatomy.next_s)
+        nexts = [(e['sub'], e['obj']) for e in blob['edges']
+                    if e['pred'] in next_predicates] if has_starts else []
+        nodes = sorted({tuple(Apinatomy.layer_regions(blob, e) for e in p) for p in nexts})
+        # nodes are in many pairs so find their anatomical layers just once
+        node_layers = {n: anatomical_layer(n[1]) for pair in nodes for n in pair if len(n[1])}
 
-        bindex = {n['id']:n for n in blob['nodes']}
         # find terminal regions and layers
-        axon_terminal_regions = Apinatomy.find_terminal_region_layers(blob, Apinatomy.axon, bindex)
-        dendrite_terminal_regions = Apinatomy.find_terminal_region_layers(blob, Apinatomy.dendrite, bindex)
+        axon_terminal_regions = Apinatomy.find_terminal_region_layers(blob, Apinatomy.axon)
+        dendrite_terminal_regions = Apinatomy.find_terminal_region_layers(blob, Apinatomy.dendrite)
+        errors = []
+        if (axon_error := axon_terminal_regions.get('error')) is not None:
+            errors.append(f'find axon: {axon_error}')
+        if (dendrite_error := dendrite_terminal_regions.get('error')) is not None:
+            errors.append(f'find dendrite: {dendrite_error}')
         return {
-            'axons': [al for al in set(anatomical_layer([ ((l['id'] if l is not None else l), r['id']) ])
-                        for r, l in axon_terminal_regions['terminal-regions']) if al is not None],
-            'dendrites': [al for al in set(anatomical_layer([ ((l['id'] if l is not None else l), r['id']) ])
-                            for r, l in dendrite_terminal_regions['terminal-regions']) if al is not None],
-            'connectivity': [ (al0, al1) for (al0, al1) in set((anatomical_layer(n0[1:][0]), anatomical_layer(n1[1:][0]))
-                                for n0, n1 in nodes if n0[1:] != n1[1:] and len(n0[1:][0]) and len(n1[1:][0])) ## This removes self edges... (ICNs)
+            'axons': [al for al in {anatomical_layer([ ((l['id'] if l is not None else l), r['id']) ])
+                        for r, l in axon_terminal_regions['terminal-regions']} if al is not None],
+            'dendrites': [al for al in {anatomical_layer([ ((l['id'] if l is not None else l), r['id']) ])
+                            for r, l in dendrite_terminal_regions['terminal-regions']} if al is not None],
+            'connectivity': [ (al0, al1) for (al0, al1) in {(node_layers[n0], node_layers[n1])
+                                for n0, n1 in nodes if n0[1:] != n1[1:] and len(n0[1:][0]) and len(n1[1:][0])} ## This removes self edges... (ICNs)
                                     if al0 is not None and al1 is not None and al0 != al1 ],
-            'errors': [f'find axon: {axon_error}'] if (axon_error := axon_terminal_regions.get('error')) is not None else []
-                    + [f'find dendrite: {dendrite_error}'] if (dendrite_error := dendrite_terminal_regions.get('error')) is not None else []
+            'errors': errors
         }
 
     #===========================================================================
     #===========================================================================
 
-    CONNECTIVITY_ONTOLOGIES = [ 'ilxtr' ]
+    CONNECTIVITY_ONTOLOGIES = frozenset([ 'ilxtr' ])
     APINATOMY_MODEL_PREFIX = 'https://apinatomy.org/uris/models/'
+    PHENOTYPE_PREDICATES = frozenset([
+        'ilxtr:hasPhenotype',
+        'ilxtr:hasMolecularPhenotype',
+        'ilxtr:hasProjectionPhenotype',
+        'ilxtr:hasCircuitRolePhenotype',
+        'ilxtr:hasFunctionalCircuitRolePhenotype',
+    ])
 
     #===========================================================================
     @staticmethod
+    @lru_cache(maxsize=4096)
     def phenotype_for_neuron_cypher(neuron_id):
         # From https://github.com/SciCrunch/sparc-curation/blob/master/docs/queries.org#phenotypes-for-neuron
         return """
             MATCH (neupop:Class{{iri: "{NEURON_ID}"}})-[e:ilxtr:hasPhenotype!]->(phenotype) RETURN e
         """.format(NEURON_ID=neuron_id)
 
+    @staticmethod
+    def phenotype_for_neurons_cypher(neuron_ids):
+        return """
+            MATCH (neupop:Class)-[e:ilxtr:hasPhenotype!]->(phenotype) WHERE neupop.iri IN [{NEURON_IDS}] RETURN e
+        """.format(NEURON_IDS=', '.join(f'"{neuron_id}"' for neuron_id in neuron_ids))
+
     #===========================================================================
 
     @staticmethod
@@ -618,18 +794,16 @@ class Apinatomy:
                 knowledge['label'] = node['meta'].get('synonym', [neuron])[0]
                 knowledge['long-label'] = node['lbl']
                 break
-        apinatomy_neuron = None
-        for edge in data['edges']:
-            if nifstd.sub(edge, neuron) and nifstd.pred(edge, Apinatomy.annotates):
-                apinatomy_neuron = nifstd.obj(edge)
-                break
-        if apinatomy_neuron is not None:
-            references = []
-            for edge in data['edges']:
-                if nifstd.sub(edge, apinatomy_neuron) and nifstd.pred(edge, Apinatomy.references):
-                    references.append(nifstd.obj(edge))
-            knowledge['references'] = references
-        knowledge.update(Apinatomy.parse_connectivity(data))
+        with nifstd.caching(data):
+            apinatomy_neuron = None
+            for edge in nifstd.subject_edges(data, neuron):
+                if edge['pred'] == Apinatomy.annotates:
+                    apinatomy_neuron = edge['obj']
+                    break
+            if apinatomy_neuron is not None:
+                knowledge['references'] = [edge['obj'] for edge in nifstd.subject_edges(data, apinatomy_neuron)
+                                            if edge['pred'] == Apinatomy.references]
+            knowledge.update(Apinatomy.parse_connectivity(data))
         return knowledge
 
     @staticmethod
@@ -644,7 +818,7 @@ class Apinatomy:
         for node in data['nodes']:
             node_id = node['id']
             if 'Class' in (types := node.get('meta', {}).get('types', [])):
-                ontology = node_id.split(':')[0]
+                ontology = node_id.partition(':')[0]
                 if ontology in Apinatomy.CONNECTIVITY_ONTOLOGIES:
                     knowledge['paths'].append({
                         'id': node_id,
@@ -658,15 +832,17 @@ class Apinatomy:
     @staticmethod
     def phenotypes(data):
     #====================
-        phenotypes = []
+        return [edge.get('obj') for edge in data['edges']
+                    if edge.get('pred') in Apinatomy.PHENOTYPE_PREDICATES]
+
+    @staticmethod
+    def neuron_phenotypes(data):
+    #===========================
+        # Phenotypes keyed by the neuron that has them
+        phenotypes = {}
         for edge in data['edges']:
-            if edge.get('pred') in [
-                    'ilxtr:hasPhenotype',
-                    'ilxtr:hasMolecularPhenotype',
-                    'ilxtr:hasProjectionPhenotype',
-                    'ilxtr:hasCircuitRolePhenotype',
-                    'ilxtr:hasFunctionalCircuitRolePhenotype',]:
-                phenotypes.append(edge.get('obj'))
+            if edge.get('pred') in Apinatomy.PHENOTYPE_PREDICATES:
+                phenotypes.setdefault(edge.get('sub'), []).append(edge.get('obj'))
         return phenotypes
 
 #===============================================================================
@@ -19,19 +19,32 @@
 #===============================================================================
 
 from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 import os
-from typing import Optional
+import threading
 import urllib.parse
 
 #===============================================================================
 
 from .apinatomy import Apinatomy
 from .utils import log
-from .utils import request_json
+from .utils import request_json, request_json_items
 
 #===============================================================================
 
-INTERLEX_ONTOLOGIES = ['ILX', 'NLX']
+INTERLEX_ONTOLOGIES = frozenset(['ILX', 'NLX'])
+
+# Lookups mostly wait on the network so are run concurrently when there are many
+CONCURRENT_LOOKUPS = 16
+
+# Neurons per cypher query when getting phenotypes for many neurons, to
+# keep query URLs to a reasonable length
+PHENOTYPE_QUERY_NEURONS = 50
+
+# Returned by a request when SciCrunch has nothing for an entity, as
+# opposed to None when the request fails
+NOT_FOUND = object()
 
 #===============================================================================
 
@@ -70,118 +83,231 @@ class NAMESPACES:
     namespaces = {
         'ilxtr': 'http://uri.interlex.org/tgbugs/uris/readable/'
     }
+    # (prefix, namespace URI, length of namespace URI) for ``curie()``
+    prefixes = tuple((prefix, ns_uri, len(ns_uri)) for prefix, ns_uri in namespaces.items())
 
     @staticmethod
+    @lru_cache(maxsize=8192)
     def uri(curie: str) -> str:
-        parts = curie.split(':', 1)
-        if len(parts) == 2 and parts[0] in NAMESPACES.namespaces:
-            return NAMESPACES.namespaces[parts[0]] + parts[1]
+        prefix, sep, suffix = curie.partition(':')
+        if sep and (ns_uri := NAMESPACES.namespaces.get(prefix)) is not None:
+            return ns_uri + suffix
         return curie
 
     @staticmethod
+    @lru_cache(maxsize=8192)
     def curie(uri: str) -> str:
-        for prefix, ns_uri in NAMESPACES.namespaces.items():
+        for prefix, ns_uri, length in NAMESPACES.prefixes:
             if uri.startswith(ns_uri):
-                return f'{prefix}:{uri[len(ns_uri):]}'
+                return f'{prefix}:{uri[length:]}'
         return uri
 
 #===============================================================================
 
 class SciCrunch(object):
     def __init__(self, api_endpoint=SCICRUNCH_API_ENDPOINT, scicrunch_release=SCICRUNCH_PRODUCTION, scicrunch_key=None):
-        self.__api_endpoint = api_endpoint
-        self.__scicrunch_release = scicrunch_release
         self.__sparc_api_endpoint = SCICRUNCH_SPARC_API.format(API_ENDPOINT=api_endpoint,
                                                                SCICRUNCH_RELEASE=scicrunch_release)
-        self.__connectivity_query = CONNECTIVITY_QUERY if scicrunch_release == SCICRUNCH_PRODUCTION else CONNECTIVITY_QUERY_NEXT
-        self.__unknown_entities = []
+        connectivity_query = CONNECTIVITY_QUERY if scicrunch_release == SCICRUNCH_PRODUCTION else CONNECTIVITY_QUERY_NEXT
+        # Endpoint and release don't change, so bind them into our URLs once,
+        # leaving just the entity to be substituted for each lookup
+        urls = {
+            'API_ENDPOINT': api_endpoint,
+            'SCICRUNCH_RELEASE': scicrunch_release,
+            'CONNECTIVITY_QUERY': connectivity_query,
+            'TERM': '{}',
+            'NEURON_ID': '{}',
+            'MODEL_ID': '{}',
+        }
+        self.__connectivity_models_url = SCICRUNCH_CONNECTIVITY_MODELS.format(**urls)
+        self.__cypher_url = SCICRUNCH_SPARC_CYPHER.format(**urls)
+        self.__interlex_vocab_url = SCICRUNCH_INTERLEX_VOCAB.format(**urls)
+        self.__connectivity_neurons_url = SCICRUNCH_CONNECTIVITY_NEURONS.format(**urls)
+        self.__model_references_url = SCICRUNCH_MODEL_REFERENCES.format(**urls)
+        self.__sparc_vocab_url = SCICRUNCH_SPARC_VOCAB.format(**urls)
+        # How to look up an entity's knowledge, by the ontology prefix of its CURIE;
+        # anything else (including APINATOMY models) is from the SPARC vocabulary
+        self.__knowledge_lookups = {ontology: self.__interlex_knowledge for ontology in INTERLEX_ONTOLOGIES}
+        self.__knowledge_lookups.update({ontology: self.__connectivity_knowledge
+                                            for ontology in Apinatomy.CONNECTIVITY_ONTOLOGIES})
+        self.__unknown_entities = set()
+        # Entities whose most recent knowledge lookup failed, rather than finding nothing
+        self.__failed_lookups = set()
+        # Lookups in progress, shared by anyone else who asks for the same entity
+        self.__pending_knowledge = {}
+        self.__pending_lock = threading.Lock()
         self.__scicrunch_key = scicrunch_key if scicrunch_key is not None else os.environ.get('SCICRUNCH_API_KEY')
         if self.__scicrunch_key is None:
             log.warning('Undefined SCICRUNCH_API_KEY: SciCrunch knowledge will not be looked up')
+        # Query parameters common to every request
+        self.__params = {
+            'api_key': self.__scicrunch_key,
+            'limit': 9999,
+        }
 
     @property
     def sparc_api_endpoint(self):
         return self.__sparc_api_endpoint
+
+    def lookup_failed(self, entity: str) -> bool:
+    #============================================
+        # Was there an error when knowledge for the entity was last looked up? If so,
+        # ``get_knowledge()`` returned nothing without SciCrunch saying it was unknown
+        return self.__scicrunch_key is None or entity in self.__failed_lookups
+
     def connectivity_models(self):
     #=============================
         models = {}
-        if self.__scicrunch_key is not None:
-            params = {
-                'api_key': self.__scicrunch_key,
-                'limit': 9999,
-            }
-            data = request_json(SCICRUNCH_CONNECTIVITY_MODELS.format(API_ENDPOINT=self.__api_endpoint,
-                                                                     SCICRUNCH_RELEASE=self.__scicrunch_release),
-                                params=params)
-            if data is not None:
-                for node in data.get('nodes', []):
-                    models[node['id']] = node['lbl']
+        if self.__scicrunch_key is None:
+            return models
+        data = request_json(self.__connectivity_models_url, params=self.__params)
+        if data is not None:
+            for node in data.get('nodes', []):
+                models[node['id']] = node['lbl']
         return models
 
     def get_knowledge(self, entity: str) -> dict:
     #============================================
-        knowledge = {}
-        if self.__scicrunch_key is not None:
-            params = {
-                'api_key': self.__scicrunch_key,
-                'limit': 9999,
-            }
-            ontology = entity.split(':')[0]
-            if   ontology in INTERLEX_ONTOLOGIES:
-                data = request_json(SCICRUNCH_INTERLEX_VOCAB.format(API_ENDPOINT=self.__api_endpoint,
-                                                                    SCICRUNCH_RELEASE=self.__scicrunch_release,
-                                                                    TERM=entity),
-                                    params=params)
-                if data is not None:
-                    knowledge['label'] = data.get('data', {}).get('label', entity)
-            elif ontology in Apinatomy.CONNECTIVITY_ONTOLOGIES:
-                data = request_json(SCICRUNCH_CONNECTIVITY_NEURONS.format(API_ENDPOINT=self.__api_endpoint,
-                                                                          SCICRUNCH_RELEASE=self.__scicrunch_release,
-                                                                          CONNECTIVITY_QUERY=self.__connectivity_query,
-                                                                          NEURON_ID=entity),
-                                    params=params)
-                if data is not None:
-                    knowledge = Apinatomy.neuron_knowledge(entity, data)
-            elif entity.startswith(Apinatomy.APINATOMY_MODEL_PREFIX):
-                data = request_json(SCICRUNCH_MODEL_REFERENCES.format(API_ENDPOINT=self.__api_endpoint,
-                                                                      SCICRUNCH_RELEASE=self.__scicrunch_release,
-                                                                      MODEL_ID=urllib.parse.quote(entity, '')),
-                                    params=params)
-                if data is not None:
-                    knowledge = Apinatomy.model_knowledge(entity, data)
+        # Without a key there's nothing we can look up
+        if self.__scicrunch_key is None:
+            return {}
+        with self.__pending_lock:
+            if (pending := self.__pending_knowledge.get(entity)) is not None:
+                waiting = True
             else:
-                data = request_json(SCICRUNCH_SPARC_VOCAB.format(API_ENDPOINT=self.__api_endpoint,
-                                                                 SCICRUNCH_RELEASE=self.__scicrunch_release,
-                                                                 TERM=entity),
-                                    params=params)
-                if data is not None:
-                    if len(labels := data.get('labels', [])):
-                        knowledge['label'] = labels[0]
-                    else:
-                        knowledge['label'] = entity
+                waiting = False
+                pending = self.__pending_knowledge[entity] = Future()
+        if waiting:
+            return pending.result()
+        try:
+            knowledge = self.__get_knowledge(entity)
+            pending.set_result(knowledge)
+            return knowledge
+        except BaseException as exception:
+            pending.set_exception(exception)
+            raise
+        finally:
+            with self.__pending_lock:
+                del self.__pending_knowledge[entity]
+
+    def __get_knowledge(self, entity: str) -> dict:
+    #==============================================
+        lookup = self.__knowledge_lookups.get(entity.partition(':')[0], self.__vocabulary_knowledge)
+        if (knowledge := lookup(entity)) is None:
+            self.__failed_lookups.add(entity)
+            knowledge = {}
+        else:
+            self.__failed_lookups.discard(entity)
         if len(knowledge) == 0 and entity not in self.__unknown_entities:
             log.warning('Unknown anatomical entity: {}'.format(entity))
-            self.__unknown_entities.append(entity)
+            self.__unknown_entities.add(entity)
         return knowledge
 
-    def get_phenotypes(self, entity: str) -> Optional[list]:
-    #=======================================================
-        phenotypes = None
-        if self.__scicrunch_key is not None:
-            params = {
-                'api_key': self.__scicrunch_key,
-                'limit': 9999,
-            }
-            params['cypherQuery'] = Apinatomy.phenotype_for_neuron_cypher(NAMESPACES.uri(entity))
-            data = request_json(SCICRUNCH_SPARC_CYPHER.format(API_ENDPOINT=self.__api_endpoint,
-                                                              SCICRUNCH_RELEASE=self.__scicrunch_release),
-                                params=params)
-            if data is not None:
-                phenotypes = Apinatomy.phenotypes(data)
-        if phenotypes is None and entity not in self.__unknown_entities:
-            log.warning('Unknown anatomical entity: {}'.format(entity))
-            self.__unknown_entities.append(entity)
-            phenotypes = []
+    # Each of these returns None if its request fails and an empty dictionary
+    # if SciCrunch has nothing for the entity
+
+    def __interlex_knowledge(self, entity):
+    #=======================================
+        data = request_json(self.__interlex_vocab_url.format(entity),
+                            not_found=NOT_FOUND, params=self.__params)
+        if data is None:
+            return None
+        elif data is NOT_FOUND:
+            return {}
+        return {'label': data.get('data', {}).get('label', entity)}
+
+    def __connectivity_knowledge(self, entity):
+    #===========================================
+        data = request_json(self.__connectivity_neurons_url.format(entity),
+                            not_found=NOT_FOUND, params=self.__params)
+        if data is None:
+            return None
+        elif data is NOT_FOUND:
+            return {}
+        return Apinatomy.neuron_knowledge(entity, data)
+
+    def __vocabulary_knowledge(self, entity):
+    #=========================================
+        if entity.startswith(Apinatomy.APINATOMY_MODEL_PREFIX):
+            # Model references can be large, so only their nodes are kept
+            nodes = request_json_items(self.__model_references_url.format(urllib.parse.quote(entity, '')),
+                                       'nodes.item', not_found=NOT_FOUND, params=self.__params)
+            if nodes is None:
+                return None
+            elif nodes is NOT_FOUND:
+                return {}
+            return Apinatomy.model_knowledge(entity, {'nodes': nodes})
+        data = request_json(self.__sparc_vocab_url.format(entity),
+                            not_found=NOT_FOUND, params=self.__params)
+        if data is None:
+            return None
+        elif data is NOT_FOUND:
+            return {}
+        if len(labels := data.get('labels', [])):
+            return {'label': labels[0]}
+        return {'label': entity}
+
+    def get_knowledge_many(self, entities: list, max_workers: int=CONCURRENT_LOOKUPS) -> dict:
+    #=========================================================================================
+        return self.__lookup_many(self.get_knowledge, entities, max_workers)
+
+    def get_phenotypes_many(self, entities: list, max_workers: int=CONCURRENT_LOOKUPS) -> dict:
+    #==========================================================================================
+        # A single cypher query gets the phenotypes of a batch of neurons
+        entities = list(dict.fromkeys(entities))
+        if len(entities) <= 1:
+            return {entity: self.get_phenotypes(entity) for entity in entities}
+        batches = [tuple(entities[n:n+PHENOTYPE_QUERY_NEURONS])
+                    for n in range(0, len(entities), PHENOTYPE_QUERY_NEURONS)]
+        phenotypes = {}
+        for batch_phenotypes in self.__lookup_many(self.__batch_phenotypes, batches, max_workers).values():
+            phenotypes.update(batch_phenotypes)
         return phenotypes
 
+    def __batch_phenotypes(self, entities: tuple) -> dict:
+    #=====================================================
+        if self.__scicrunch_key is None:
+            return {entity: [] for entity in entities}
+        uris = [NAMESPACES.uri(entity) for entity in entities]
+        params = {**self.__params, 'cypherQuery': Apinatomy.phenotype_for_neurons_cypher(uris)}
+        # Results may identify neurons by either their IRI or CURIE
+        neurons = dict(zip(uris, entities))
+        neurons.update({entity: entity for entity in entities})
+        data = request_json(self.__cypher_url, params=params)
+        if data is not None:
+            phenotypes = {entity: [] for entity in entities}
+            for neuron, neuron_phenotypes in Apinatomy.neuron_phenotypes(data).items():
+                if (entity := neurons.get(neuron)) is not None:
+                    phenotypes[entity].extend(neuron_phenotypes)
+            return phenotypes
+        for entity in entities:
+            if entity not in self.__unknown_entities:
+                log.warning('Unknown anatomical entity: {}'.format(entity))
+                self.__unknown_entities.add(entity)
+        return {entity: [] for entity in entities}
+
+    def __lookup_many(self, lookup, entities, max_workers):
+    #======================================================
+        # Returns a dictionary of results keyed by entity, with requests for
+        # different entities made at the same time over the shared session
+        entities = list(dict.fromkeys(entities))
+        if len(entities) <= 1 or max_workers <= 1:
+            return {entity: lookup(entity) for entity in entities}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(entities))) as executor:
+            return dict(zip(entities, executor.map(lookup, entities)))
+
+    def get_phenotypes(self, entity: str) -> list:
+    #==============================================
+        if self.__scicrunch_key is None:
+            return []
+        params = {**self.__params,
+                  'cypherQuery': Apinatomy.phenotype_for_neuron_cypher(NAMESPACES.uri(entity))}
+        data = request_json(self.__cypher_url, params=params)
+        if data is not None:
+            return Apinatomy.phenotypes(data)
+        if entity not in self.__unknown_entities:
+            log.warning('Unknown anatomical entity: {}'.format(entity))
+            self.__unknown_entities.add(entity)
+        return []
+
 #===============================================================================
@@ -22,24 +22,95 @@ try:
 except ImportError:
     import logging as log
 
+try:
+    import orjson
+    from orjson import loads as json_loads
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+    from json import loads as json_loads
+    def json_dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+# Large responses can be parsed as they are received, if ``ijson`` is available
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 #===============================================================================
 
+import atexit
 from json import JSONDecodeError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
 
 LOOKUP_TIMEOUT = 30    # seconds; for `requests.get()`
+CONNECTION_POOL_SIZE = 32
+STREAM_CHUNK_SIZE = 64*1024   # bytes; for parsing streamed responses
+MAX_RETRY_AFTER = 60   # seconds
+
+#===============================================================================
+
+class LookupRetry(Retry):
+    # Don't let a server's Retry-After keep a lookup waiting for more than
+    # ``MAX_RETRY_AFTER`` seconds
+    def get_retry_after(self, response):
+    #===================================
+        retry_after = super().get_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, MAX_RETRY_AFTER)
+        return None
+
+# Retry transient server errors and rate limiting, backing off exponentially
+# between attempts or waiting for as long as the server's (capped) Retry-After
+# says. Other client errors are not retried
+LOOKUP_RETRIES = LookupRetry(total=5, backoff_factor=0.5,
+                             status_forcelist=(429, 502, 503, 504),
+                             allowed_methods=frozenset(['GET']),
+                             respect_retry_after_header=True,
+                             raise_on_status=False)
+
+#===============================================================================
+
+# A single session, shared by all SciCrunch instances, so that connections
+# are kept alive and reused across requests
+
+session = requests.Session()
+# Ask for compressed responses using every encoding that urllib3 can decode
+# (which includes Brotli and Zstandard when their packages are installed)
+session.headers.update({'Accept': 'application/json',
+                        'Accept-Encoding': ACCEPT_ENCODING})
+for prefix in ['http://', 'https://']:
+    session.mount(prefix, HTTPAdapter(pool_connections=CONNECTION_POOL_SIZE,
+                                      pool_maxsize=CONNECTION_POOL_SIZE,
+                                      max_retries=LOOKUP_RETRIES))
+atexit.register(session.close)
 
 #===============================================================================
 
-def request_json(endpoint, **kwds):
+# Returns None if the request fails. If ``not_found`` is given it is returned,
+# rather than failing, when the endpoint has nothing for the request (i.e.
+# a 404 status or an empty response)
+
+def request_json(endpoint, not_found=None, **kwds):
     try:
-        response = requests.get(endpoint,
-                                headers={'Accept': 'application/json'},
-                                timeout=LOOKUP_TIMEOUT,
-                                **kwds)
-        if response.status_code == requests.codes.ok:
+        response = session.get(endpoint,
+                               timeout=LOOKUP_TIMEOUT,
+                               **kwds)
+        if (not_found is not None
+        and (response.status_code == requests.codes.not_found
+          or response.status_code == requests.codes.ok and not response.content)):
+            return not_found
+        if response.status_code == requests.codes.ok and not response.content:
+            error = 'Empty response'
+        elif response.status_code == requests.codes.ok:
             try:
-                return response.json()
+                return json_loads(response.content)
             except JSONDecodeError:
                 error = 'Invalid JSON returned'
         else:
@@ -50,3 +121,48 @@ def request_json(endpoint, **kwds):
     return None
 
 #===============================================================================
+
+def request_json_items(endpoint, prefix, not_found=None, **kwds):
+    # Returns a list of the items at ``prefix`` in the JSON response (e.g.
+    # ``nodes.item``), parsing them as they are received so the full response
+    # isn't held in memory as well as the items. Failures and ``not_found``
+    # are as for ``request_json()``
+    if ijson is None:
+        if (data := request_json(endpoint, not_found=not_found, **kwds)) is not None:
+            if data is not_found:
+                return data
+            for key in prefix.split('.')[:-1]:
+                data = data.get(key, {})
+            return list(data)
+        return None
+    try:
+        with session.get(endpoint, timeout=LOOKUP_TIMEOUT, stream=True, **kwds) as response:
+            if not_found is not None and response.status_code == requests.codes.not_found:
+                return not_found
+            if response.status_code == requests.codes.ok:
+                # Decoded content is pushed to the parser, so that an empty response
+                # is recognised whatever its transfer and content encodings
+                items = ijson.sendable_list()
+                parser = ijson.items_coro(items, prefix)
+                empty = True
+                try:
+                    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                        if chunk:
+                            empty = False
+                            parser.send(chunk)
+                    if not empty:
+                        parser.close()
+                        return list(items)
+                    elif not_found is not None:
+                        return not_found
+                    error = 'Empty response'
+                except ijson.JSONError:
+                    error = 'Invalid JSON returned'
+            else:
+                error = response.reason
+    except (requests.exceptions.RequestException, HTTPError) as exception:
+        error = f'Exception: {exception}'
+    log.warning(f"Couldn't access {endpoint}: {error}")
+    return None
+
+#===============================================================================
@@ -0,0 +1,113 @@
+#===============================================================================
+
+import gzip
+import http.server
+import threading
+import unittest
+from unittest import mock
+
+import mapknowledge.utils as utils
+
+#===============================================================================
+
+NOT_FOUND = object()
+
+NODES = b'{"nodes": [{"id": "ilxtr:a"}, {"id": "ilxtr:b"}]}'
+
+#===============================================================================
+
+class ResponseHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+    #================
+        if self.path == '/missing':
+            self.__send(404, b'')
+        elif self.path == '/empty':
+            self.__send(200, b'')
+        elif self.path == '/empty-chunked':
+            self.__send(200, b'', chunked=True)
+        elif self.path == '/empty-gzip':
+            self.__send(200, gzip.compress(b''), {'Content-Encoding': 'gzip'}, chunked=True)
+        elif self.path == '/nodes-chunked':
+            self.__send(200, NODES, chunked=True)
+        elif self.path == '/invalid':
+            self.__send(200, b'{"nodes": [{"id"')
+
+    def __send(self, status, body, headers={}, chunked=False):
+    #=========================================================
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if chunked:
+            if body:
+                self.wfile.write(f'{len(body):x}\r\n'.encode() + body + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+    #============================
+        pass
+
+#===============================================================================
+
+class RequestJsonItemsTests:
+    def setUp(self):
+    #===============
+        if self.use_ijson and utils.ijson is None:
+            self.skipTest('ijson is not installed')
+        self.__server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ResponseHandler)
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        self.__endpoint = f'http://127.0.0.1:{self.__server.server_port}'
+        if not self.use_ijson:
+            patcher = mock.patch.object(utils, 'ijson', None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+    #==================
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def items(self, path, not_found=NOT_FOUND):
+    #==========================================
+        return utils.request_json_items(self.__endpoint + path, 'nodes.item', not_found=not_found)
+
+    def test_empty_responses_are_not_found(self):
+    #============================================
+        for path in ['/missing', '/empty', '/empty-chunked', '/empty-gzip']:
+            with self.subTest(path=path):
+                self.assertIs(self.items(path), NOT_FOUND)
+
+    def test_empty_responses_fail_without_not_found(self):
+    #=====================================================
+        for path in ['/empty', '/empty-chunked', '/empty-gzip']:
+            with self.subTest(path=path):
+                self.assertIsNone(self.items(path, not_found=None))
+
+    def test_items(self):
+    #====================
+        self.assertEqual(self.items('/nodes-chunked'), [{'id': 'ilxtr:a'}, {'id': 'ilxtr:b'}])
+
+    def test_invalid_json_fails(self):
+    #=================================
+        self.assertIsNone(self.items('/invalid'))
+
+class StreamedItemsTests(RequestJsonItemsTests, unittest.TestCase):
+    use_ijson = True
+
+class LoadedItemsTests(RequestJsonItemsTests, unittest.TestCase):
+    use_ijson = False
+
+#===============================================================================
+
+if __name__ == '__main__':
+    unittest.main()
+
+#===============================================================================